@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+import os, sys, math, time, json, shutil, socket, struct, tempfile, zipfile
+import threading, multiprocessing, httplib
+from base64 import urlsafe_b64encode
+from optparse import OptionParser
+from Queue import Queue
+import SimpleHTTPServer, SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+"""
+
+  An offline benchmark of the TileLive endpoints. Serves a generated
+  shapefile and mapfiles from a local HTTP server, starts a TileLive
+  server against them and measures throughput and latency of tile, grid,
+  data tile and inspect requests in the following phases:
+
+  cold    first request for each of a set of new maps, which pays for
+          PreCache downloads and compiling the mapfile
+  warm    uncached tiles of a map that is already loaded
+  cached  the same tiles again, served from the tile cache
+  inspect the inspection endpoints of a loaded map
+
+"""
+
+MERCATOR = "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs +over"
+
+MAPFILE = """<?xml version="1.0" encoding="utf-8"?>
+<Map srs="%(srs)s">
+  <MetaWriter name="metawriter" only-nonempty="false" type="point"
+    file="[tile_dir]/[z]/[x]/[y].json" />
+  <Stylesheet>
+    Map { map-bgcolor: #fff; }
+    #cells { polygon-fill: #69c; line-color: #036; line-width: 0.5;
+      polygon-meta-writer: metawriter; polygon-meta-output: "id,name"; }
+  </Stylesheet>
+  <Layer id="cells" srs="+proj=latlong +ellps=WGS84 +datum=WGS84 +no_defs">
+    <Datasource>
+      <Parameter name="type">shape</Parameter>
+      <Parameter name="id">cells</Parameter>
+      <Parameter name="file">%(data_url)s</Parameter>
+    </Datasource>
+  </Layer>
+</Map>
+"""
+
+def write_shapefile(path, cells):
+    """ write a cells x cells grid of polygons covering the world, with
+    an integer id and a name field, as path.shp, .shx and .dbf """
+    records = []
+    for row in range(cells):
+        for column in range(cells):
+            minx = -180 + 360.0 * column / cells
+            maxx = minx + 360.0 / cells
+            miny = -85 + 170.0 * row / cells
+            maxy = miny + 170.0 / cells
+            ring = [(minx, miny), (minx, maxy), (maxx, maxy), (maxx, miny), (minx, miny)]
+            records.append((ring, len(records), 'cell %d %d' % (column, row)))
+
+    def header(length):
+        return struct.pack('>7i', 9994, 0, 0, 0, 0, 0, length / 2) + \
+            struct.pack('<2i4d4d', 1000, 5, -180, -85, 180, 85, 0, 0, 0, 0)
+
+    shp, shx = [], []
+    offset = 100
+    for ring, id, name in records:
+        xs, ys = [p[0] for p in ring], [p[1] for p in ring]
+        content = struct.pack('<i4d2i', 5, min(xs), min(ys), max(xs), max(ys), 1, len(ring)) + \
+            struct.pack('<i', 0) + ''.join(struct.pack('<2d', *p) for p in ring)
+        shp.append(struct.pack('>2i', id + 1, len(content) / 2) + content)
+        shx.append(struct.pack('>2i', offset / 2, len(content) / 2))
+        offset += 8 + len(content)
+    with open(path + '.shp', 'wb') as f:
+        f.write(header(offset) + ''.join(shp))
+    with open(path + '.shx', 'wb') as f:
+        f.write(header(100 + 8 * len(shx)) + ''.join(shx))
+
+    fields = [('id', 'N', 10), ('name', 'C', 32)]
+    with open(path + '.dbf', 'wb') as f:
+        f.write(struct.pack('<4BIHH20x', 3, 110, 1, 1, len(records),
+            32 + 32 * len(fields) + 1, 1 + sum(l for n, t, l in fields)))
+        for name, type, length in fields:
+            f.write(struct.pack('<11sc4xBB14x', name, type, length, 0))
+        f.write('\r')
+        for ring, id, name in records:
+            f.write(' ' + str(id).rjust(10) + name.ljust(32))
+        f.write('\x1a')
+
+def write_fixtures(directory, data_url, maps, cells):
+    """ write a zipped shapefile and mapfiles into a directory. every map
+    gets its own copy of the data so that each one is downloaded cold """
+    write_shapefile(os.path.join(directory, 'cells'), cells)
+    mapfiles = []
+    for i in range(maps):
+        with zipfile.ZipFile(os.path.join(directory, 'cells-%d.zip' % i), 'w') as z:
+            for extension in ('shp', 'shx', 'dbf'):
+                z.write(os.path.join(directory, 'cells.' + extension), 'cells.' + extension)
+        with open(os.path.join(directory, 'map-%d.mml' % i), 'w') as f:
+            f.write(MAPFILE % {'srs': MERCATOR,
+                'data_url': '%s/cells-%d.zip' % (data_url, i)})
+        mapfiles.append('%s/map-%d.mml' % (data_url, i))
+    return mapfiles
+
+class FixtureHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    directory = None
+
+    def translate_path(self, path):
+        # ignore query strings and serve from the fixture directory only
+        return os.path.join(self.directory,
+            os.path.basename(path.split('?', 1)[0]))
+
+    def log_message(self, *args):
+        pass
+
+def serve_fixtures(directory, port):
+    """ serve fixture files in a background thread """
+    class handler(FixtureHandler):
+        pass
+    handler.directory = directory
+    SocketServer.TCPServer.allow_reuse_address = True
+    httpd = SocketServer.ThreadingTCPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
+
+def serve_tilelive(argv):
+    """ run a TileLive server with the given command line options """
+    import tornado.httpserver, tornado.ioloop, tornado.options
+    from tilelive import server
+    tornado.options.parse_command_line(['tilelive'] + argv)
+    http_server = tornado.httpserver.HTTPServer(server.Application())
+    http_server.listen(tornado.options.options.port)
+    tornado.ioloop.IOLoop.instance().start()
+
+def wait_for(port, timeout=30):
+    """ wait until a port accepts connections """
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception('Server on port %d did not start' % port)
+
+def tile_coordinates(count, minzoom):
+    """ the first count tiles in zoom, row, column order from minzoom """
+    tiles = []
+    z = minzoom
+    while len(tiles) < count:
+        for x in range(2 ** z):
+            for y in range(2 ** z):
+                tiles.append((z, x, y))
+        z += 1
+    return tiles[:count]
+
+def endpoint_paths(endpoint, mapfile, tiles, join_field='name'):
+    mapfile_64 = urlsafe_b64encode(mapfile)
+    if endpoint == 'tile':
+        return ['/tile/%s/%d/%d/%d.png' % ((mapfile_64,) + t) for t in tiles]
+    elif endpoint == 'grid':
+        return ['/tile/%s/%d/%d/%d.%s.grid.json' % ((mapfile_64,) + t +
+            (urlsafe_b64encode(join_field),)) for t in tiles]
+    elif endpoint == 'data':
+        return ['/tile/%s/%d/%d/%d.json' % ((mapfile_64,) + t) for t in tiles]
+    elif endpoint == 'inspect':
+        layer_64, field_64 = urlsafe_b64encode('cells'), urlsafe_b64encode(join_field)
+        return ['/%s/fields.json' % mapfile_64,
+            '/%s/%s/layer.json' % (mapfile_64, layer_64)] + \
+            ['/%s/%s/%s/values.json?start=%d' % (mapfile_64, layer_64, field_64, start)
+                for start in range(0, 30 * len(tiles), 30)]
+
+def request_all(port, paths, concurrency):
+    """ request paths over keep-alive connections from concurrency threads.
+    returns the latency of each request and the number of failures """
+    queue = Queue()
+    for path in paths:
+        queue.put(path)
+    latencies, errors = [], []
+    def client():
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=300)
+        while True:
+            try:
+                path = queue.get_nowait()
+            except Exception:
+                break
+            start = time.time()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors.append(path)
+            except Exception:
+                errors.append(path)
+                conn.close()
+                conn = httplib.HTTPConnection('127.0.0.1', port, timeout=300)
+            latencies.append(time.time() - start)
+        conn.close()
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    return latencies, len(errors)
+
+def percentile(values, p):
+    """ nearest-rank percentile of a list of values """
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+def measure(port, paths, concurrency):
+    start = time.time()
+    latencies, errors = request_all(port, paths, concurrency)
+    elapsed = time.time() - start
+    result = {'requests': len(paths), 'errors': errors, 'elapsed': elapsed,
+        'throughput': len(paths) / elapsed if elapsed else 0}
+    for p in (50, 95, 99):
+        result['p%d_ms' % p] = percentile(latencies, p) * 1000 if latencies else None
+    return result
+
+def run(options, server_args):
+    workdir = tempfile.mkdtemp(prefix='tilelive-benchmark-')
+    try:
+        fixtures = os.path.join(workdir, 'fixtures')
+        os.mkdir(fixtures)
+        mapfiles = write_fixtures(fixtures, 'http://127.0.0.1:%d' % options.fixture_port,
+            options.maps, options.cells)
+        httpd = serve_fixtures(fixtures, options.fixture_port)
+
+        argv = ['--port=%d' % options.port,
+            '--inspect=true',
+            '--tile_cache_dir=%s' % os.path.join(workdir, 'tiles'),
+            '--map_cache_dir=%s' % os.path.join(workdir, 'mapfiles')] + server_args
+        server = multiprocessing.Process(target=serve_tilelive, args=(argv,))
+        server.daemon = True
+        server.start()
+        try:
+            wait_for(options.port)
+            tiles = tile_coordinates(options.tiles, options.minzoom)
+            results = {'options': argv, 'phases': {}}
+            phases = results['phases']
+            phases['cold'] = {'tile': measure(options.port,
+                [endpoint_paths('tile', mapfile, tiles[:1])[0] for mapfile in mapfiles],
+                options.concurrency)}
+            for phase in ('warm', 'cached'):
+                phases[phase] = {}
+                for endpoint in ('tile', 'grid', 'data'):
+                    phases[phase][endpoint] = measure(options.port,
+                        endpoint_paths(endpoint, mapfiles[0], tiles), options.concurrency)
+            phases['inspect'] = {'inspect': measure(options.port,
+                endpoint_paths('inspect', mapfiles[0], tiles[:10]), options.concurrency)}
+        finally:
+            server.terminate()
+            httpd.shutdown()
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+def failures(results):
+    """ the phases and endpoints of which every request failed """
+    return ['%s/%s' % (phase, endpoint)
+        for phase, endpoints in sorted(results['phases'].items())
+        for endpoint, r in sorted(endpoints.items())
+        if r['requests'] and r['errors'] == r['requests']]
+
+def report(results, baseline=None):
+    """ print a table of results, with the change in throughput against a
+    baseline run if one is given """
+    print "%-8s %-8s %8s %7s %10s %9s %9s %9s %8s" % ('phase', 'endpoint',
+        'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'change')
+    for phase in ('cold', 'warm', 'cached', 'inspect'):
+        for endpoint, r in sorted(results['phases'][phase].items()):
+            change = ''
+            if baseline:
+                b = baseline['phases'].get(phase, {}).get(endpoint)
+                if b and b['throughput']:
+                    change = '%+.1f%%' % ((r['throughput'] / b['throughput'] - 1) * 100)
+            print "%-8s %-8s %8d %7d %10.1f %9.1f %9.1f %9.1f %8s" % (phase, endpoint,
+                r['requests'], r['errors'], r['throughput'],
+                r['p50_ms'] or 0, r['p95_ms'] or 0, r['p99_ms'] or 0, change)
+
+if __name__ == "__main__":
+    """ run as a command-line tool """
+
+    parser = OptionParser(usage="""%prog [options] [-- tilelive options...]""")
+    parser.add_option('-c', '--concurrency', dest='concurrency', type='int', default=4,
+                      help='Number of concurrent clients. Default 4.')
+    parser.add_option('-n', '--tiles', dest='tiles', type='int', default=100,
+                      help='Number of tiles requested from each endpoint. Default 100.')
+    parser.add_option('-z', '--minzoom', dest='minzoom', type='int', default=2,
+                      help='Zoom level of the first tiles requested. Default 2.')
+    parser.add_option('-m', '--maps', dest='maps', type='int', default=4,
+                      help='Number of distinct maps loaded cold. Default 4.')
+    parser.add_option('--cells', dest='cells', type='int', default=64,
+                      help='Rows and columns of the polygon grid used as data. Default 64.')
+    parser.add_option('-p', '--port', dest='port', type='int', default=8899,
+                      help='Port of the TileLive server. Default 8899.')
+    parser.add_option('--fixture-port', dest='fixture_port', type='int', default=8898,
+                      help='Port of the fixture HTTP server. Default 8898.')
+    parser.add_option('-o', '--output', dest='output',
+                      help='Write results as JSON to this file.')
+    parser.add_option('-b', '--baseline', dest='baseline',
+                      help='Compare against results of an earlier run.')
+
+    options, server_args = parser.parse_args()
+    results = run(options, server_args)
+    baseline = None
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+    report(results, baseline)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    failed = failures(results)
+    if failed:
+        # a phase that only measured errors says nothing about performance
+        print >> sys.stderr, "Every request failed in: %s" % ', '.join(failed)
+        sys.exit(1)
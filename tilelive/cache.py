@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 
-import os, time, copy,tempfile, urllib2, urlparse
-import zipfile, shutil, logging
-import tornado, StringIO
+import os, tempfile, urllib2, urlparse, json, sqlite3
+import zipfile, shutil, logging, hashlib, time, threading, atexit
+import email.utils
+from Queue import Queue
+import tornado
+from collections import OrderedDict
 
 import cascadenik
 import tornado.httpclient
-import safe64
+import metrics, safe64, sqlitestore
 
 try:
     import mapnik2 as mapnik
@@ -32,6 +35,23 @@ non-managed file cache of all files of each.
 
 """
 
+DOWNLOAD_SECONDS = metrics.histogram('tilelive_download_seconds',
+    'Time to download a datasource')
+DOWNLOAD_FAILURES = metrics.counter('tilelive_download_failures_total',
+    'Datasource downloads or extractions that failed')
+UNZIP_SECONDS = metrics.histogram('tilelive_unzip_seconds',
+    'Time to extract a downloaded datasource')
+COMPILE_SECONDS = metrics.histogram('tilelive_compile_seconds',
+    'Time to compile a mapfile with cascadenik')
+LOAD_SECONDS = metrics.histogram('tilelive_load_seconds',
+    'Time to load a compiled map into mapnik')
+CACHE_WRITE_SECONDS = metrics.histogram('tilelive_cache_write_seconds',
+    'Time to store a tile in the tile cache')
+WRITE_BEHIND_SECONDS = metrics.histogram('tilelive_write_behind_seconds',
+    'Time a tile waits to be written by the write-behind thread')
+QUOTA_EVICTIONS = metrics.counter('tilelive_tile_cache_evictions_total',
+    'Tiles removed from the tile cache to stay within its quota')
+
 class TLCache(object):
     """ base cache object for TileLite """
     def __init__(self, **kwargs):
@@ -54,14 +74,147 @@ class TLCache(object):
         if not os.path.isfile(local_url):
             url = self.fs2url(in_url)
             remote_file = urllib2.urlopen(url)
-            output = open(local_url, 'wb')
-            output.write(remote_file.read())
-            output.close()
+            # other processes may read the file as soon as it exists
+            output = tempfile.NamedTemporaryFile(dir=self.directory,
+                prefix='.download-', delete=False)
+            try:
+                shutil.copyfileobj(remote_file, output)
+                output.close()
+                os.rename(output.name, local_url)
+            finally:
+                if os.path.isfile(output.name):
+                    os.remove(output.name)
         return local_url
 
 class TileCache(TLCache):
+    """ cache of rendered tiles. tiles are stored as files under
+    tile/<mapfile>/ by default, or in a storage backend from BACKENDS.
+    the HTTP validators of a tile file are its modification time and size.
+    storage backends keep a content hash and time with every tile.
+
+    the tiles of a mapfile can be versioned in generations. tile/<mapfile>
+    is then a symlink to tile/.generations/<mapfile>/<generation>, which is
+    switched atomically to invalidate all tiles of a mapfile at once, and
+    storage backends keep a database per generation. earlier generations
+    are removed by a background thread.
+
+    with a quota in bytes, tile files are removed in least recently used
+    order by a DiskQuota sweeper once they take up more space.
+
+    tile files are written to a temporary file and renamed into place, so
+    that nginx never serves a partly written tile. persist() hands the
+    write to a background thread; until it lands, the tile is served from
+    memory. once `backlog` writes are queued, tiles are written right away
+    instead, and queued writes are completed on exit """
+    def __init__(self, **kwargs):
+        TLCache.__init__(self, **kwargs)
+        self.backend = kwargs.get('backend', 'file')
+        self.store = None
+        if self.backend != 'file':
+            self.store = BACKENDS[self.backend](os.path.join(self.directory, 'tile'))
+        self.garbage = Queue()
+        self.collector = None
+        self.writes = Queue(kwargs.get('backlog', 1000))
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.writer = None
+        self.quota = None
+        if kwargs.get('quota', 0) and self.store:
+            logging.warning('The tile cache quota only applies to the file backend')
+        elif kwargs.get('quota', 0):
+            self.quota = DiskQuota(self, kwargs['quota'])
+        atexit.register(self.drain)
+
+    def generation(self, mapfile):
+        """ the current generation of the tiles of a mapfile, or None if
+        they are not versioned """
+        try:
+            return os.path.basename(os.readlink(
+                os.path.join(self.directory, 'tile', mapfile)))
+        except OSError:
+            return None
+
+    def generation_dir(self, mapfile, generation):
+        return os.path.join(self.directory, 'tile', '.generations', mapfile, generation)
+
+    def key(self, mapfile):
+        """ the name of the current generation of a mapfile in storage
+        backends """
+        generation = self.generation(mapfile)
+        if generation:
+            return "%s.%s" % (mapfile, generation)
+        return mapfile
+
+    def key_url(self, key, url):
+        """ the local path of a tile by its key() """
+        # base64 mapfile names have no dots
+        mapfile, dot, generation = key.partition('.')
+        if generation:
+            return os.path.join(self.generation_dir(mapfile, generation), url)
+        return os.path.join(self.directory, 'tile', mapfile, url)
+
+    def set_generation(self, mapfile, generation):
+        """ make generation the current generation of the tiles of a
+        mapfile. unversioned tiles become the first generation, tiles of
+        any other generation are invalidated """
+        current = self.generation(mapfile)
+        if current == generation:
+            return
+        link = os.path.join(self.directory, 'tile', mapfile)
+        target = self.generation_dir(mapfile, generation)
+        old_key, new_key = self.key(mapfile), "%s.%s" % (mapfile, generation)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        if current is None and os.path.isdir(link):
+            os.rename(link, target)
+        elif not os.path.isdir(target):
+            os.mkdir(target)
+        # replace the link atomically, relative so that it survives the
+        # cache directory being moved or mounted elsewhere
+        temporary = "%s.%d.tmp" % (link, os.getpid())
+        os.symlink(os.path.join('.generations', mapfile, generation), temporary)
+        os.rename(temporary, link)
+        logging.info('Tiles of %s are now generation %s', mapfile, generation)
+        for store in filter(None, [self.store]):
+            store.close(old_key)
+            for old, new in zip(store.files(old_key), store.files(new_key)):
+                if os.path.isfile(old):
+                    if current is None:
+                        os.rename(old, new)
+                    else:
+                        self.collect(old)
+        for other in os.listdir(os.path.dirname(target)):
+            if other != generation:
+                self.collect(os.path.join(os.path.dirname(target), other))
+                if self.quota:
+                    self.quota.forget("%s.%s" % (mapfile, other))
+
+    def collect(self, path):
+        """ remove a path in the background """
+        if self.collector is None:
+            self.collector = threading.Thread(target=self.collect_garbage)
+            self.collector.daemon = True
+            self.collector.start()
+        self.garbage.put(path)
+
+    def collect_garbage(self):
+        """ collector thread: remove earlier generations one by one """
+        while True:
+            path = self.garbage.get()
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            except OSError, e:
+                logging.error('Could not remove %s: %s', path, e)
 
     def local_url(self, mapfile, url):
+        # resolved when called, so that renders still running when the
+        # generation changes write into the generation being removed
+        generation = self.generation(mapfile)
+        if generation:
+            return os.path.join(self.generation_dir(mapfile, generation), url)
         return os.path.join(self.directory, 
             'tile', 
             mapfile, 
@@ -75,33 +228,339 @@ class TileCache(TLCache):
             os.makedirs(os.path.split(self.local_url(mapfile, url))[0])
 
     def contains(self, mapfile, url):
-        return os.path.isfile(self.local_url(mapfile, url))
+        if self.store:
+            return self.store.contains(self.key(mapfile), url)
+        return self.pending.has_key((self.key(mapfile), url)) or \
+            os.path.isfile(self.local_url(mapfile, url))
 
     def set(self, mapfile, url, data):
-        self.prepare_dir(mapfile, url)
-        with open(self.local_url(mapfile, url), 'wb') as output:
+        with CACHE_WRITE_SECONDS.time():
+            if self.store:
+                return self.store.set(self.key(mapfile), url, data)
+            self.write(self.local_url(mapfile, url), data)
+            if self.quota:
+                self.quota.touch(self.key(mapfile), url, len(data or ''))
+            return self.local_url(mapfile, url)
+
+    def write(self, path, data, modified=None):
+        """ write a tile file atomically, with the given modification time """
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created concurrently
+                if not os.path.isdir(directory):
+                    raise
+        output = tempfile.NamedTemporaryFile(dir=directory, prefix='.tile-',
+            delete=False)
+        try:
             if (data):
                 output.write(data)
-            return self.local_url(mapfile, url)
+            output.close()
+            os.chmod(output.name, 0644)
+            if modified is not None:
+                os.utime(output.name, (modified, modified))
+            os.rename(output.name, path)
+        except:
+            os.remove(output.name)
+            raise
+
+    def persist(self, mapfile, url, data):
+        """ store a tile without waiting for the disk. the file is written
+        by the write-behind thread and served from memory until then. its
+        modification time is that of this call, so that its validators do
+        not change once it is written """
+        if self.store:
+            # storage backends already hold writes back for a batch
+            return self.set(mapfile, url, data)
+        key = self.key(mapfile)
+        if self.writes.full():
+            # the disk is falling behind, so this tile waits for it
+            with self.pending_lock:
+                self.pending.pop((key, url), None)
+            return self.set(mapfile, url, data)
+        tile = (data, int(time.time()))
+        with self.pending_lock:
+            self.pending[(key, url)] = tile
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_behind)
+            self.writer.daemon = True
+            self.writer.start()
+        self.writes.put((key, url, tile, time.time()))
+
+    def write_behind(self):
+        """ writer thread: write persisted tiles to disk in order """
+        while True:
+            key, url, tile, queued = self.writes.get()
+            data, modified = tile
+            try:
+                # tiles of a generation that was replaced meanwhile are
+                # dropped, as are tiles that were written again since
+                if key == self.key(key.partition('.')[0]) and \
+                    self.pending.get((key, url)) is tile:
+                    self.write(self.key_url(key, url), data, modified)
+                    if self.quota:
+                        self.quota.touch(key, url, len(data or ''))
+                WRITE_BEHIND_SECONDS.observe(time.time() - queued)
+            except (IOError, OSError), e:
+                logging.error('Could not write tile %s of %s: %s', url, key, e)
+            with self.pending_lock:
+                if self.pending.get((key, url)) is tile:
+                    del self.pending[(key, url)]
+            self.writes.task_done()
+
+    def drain(self):
+        """ wait for the writes queued for the writer thread and write the
+        tiles held back by the backend, so that none are lost on exit """
+        if self.writer is not None and self.writer.is_alive():
+            self.writes.join()
+        if self.store:
+            self.store.flush()
+
+    def touch(self, mapfile, url):
+        """ record a use of a tile that was not read, for the quota """
+        if self.quota:
+            self.quota.touch(self.key(mapfile), url)
 
     def get(self, mapfile, url):
+        if self.store:
+            return self.store.get(self.key(mapfile), url)
+        if self.quota:
+            self.quota.touch(self.key(mapfile), url)
+        tile = self.pending.get((self.key(mapfile), url))
+        if tile is not None:
+            return tile[0]
         with open(self.local_url(mapfile, url), 'r') as f:
             return f.read()
 
+    def validators(self, mapfile, url):
+        """ the (etag, modification time) of a tile, without reading it """
+        key = self.key(mapfile)
+        if self.store:
+            return self.store.validators(key, url)
+        tile = self.pending.get((key, url))
+        if tile is not None:
+            modified, size = tile[1], len(tile[0] or '')
+        else:
+            st = os.stat(self.key_url(key, url))
+            modified, size = int(st.st_mtime), st.st_size
+        return '%x-%x' % (modified, size), modified
+
+    def flush(self):
+        """ persist writes that the backend is holding back for a batch """
+        if self.store:
+            self.store.flush()
+
+class DiskQuota(object):
+    """ keeps the tile files of a TileCache within a size in bytes. the
+    size and last access of every tile are recorded in memory by the
+    request handlers and written to an SQLite index, access.sqlite, by a
+    sweeper thread, which removes the least recently used tiles whenever
+    the total exceeds the quota. tiles that were cached before the index
+    existed are indexed by a single walk of the cache directory """
+    def __init__(self, tile_cache, quota, **kwargs):
+        self.tile_cache = tile_cache
+        self.quota = quota
+        self.interval = kwargs.get('interval', 10)
+        self.batch = kwargs.get('batch', 500)
+        self.path = os.path.join(tile_cache.directory, 'access.sqlite')
+        self.accesses = {}
+        self.forgotten = []
+        self.bytes = 0
+        self.sweeper = threading.Thread(target=self.run)
+        self.sweeper.daemon = True
+        self.sweeper.start()
+
+    def touch(self, key, url, size=None):
+        """ record an access to a tile, and its size if it was written """
+        self.accesses[(key, url)] = (size, time.time())
+
+    def forget(self, key):
+        """ drop all tiles of a removed generation from the index """
+        self.forgotten.append(key)
+
+    def run(self):
+        """ sweeper thread """
+        db = sqlite3.connect(self.path)
+        db.text_factory = str
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS tiles (key TEXT, url TEXT, '
+            'size INTEGER, atime REAL, PRIMARY KEY (key, url))')
+        db.execute('CREATE INDEX IF NOT EXISTS tiles_atime ON tiles (atime)')
+        db.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY)')
+        if not db.execute("SELECT 1 FROM state WHERE name = 'indexed'").fetchone():
+            self.index_directory(db)
+        self.bytes = db.execute('SELECT COALESCE(SUM(size), 0) FROM tiles').fetchone()[0]
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep(db)
+            except Exception:
+                logging.exception('Tile cache sweep failed')
+
+    def index_directory(self, db):
+        """ index the tiles already on disk, by their modification time """
+        root = os.path.join(self.tile_cache.directory, 'tile')
+        rows = []
+        for directory, dirs, files in os.walk(root):
+            parts = os.path.relpath(directory, root).split(os.sep)
+            if parts[0] == '.generations' and len(parts) >= 3:
+                key, url = "%s.%s" % (parts[1], parts[2]), parts[3:]
+            elif parts[0] not in ('.', '.generations'):
+                key, url = parts[0], parts[1:]
+            else:
+                continue
+            for name in files:
+                path = os.path.join(directory, name)
+                rows.append((key, '/'.join(url + [name]),
+                    os.path.getsize(path), os.path.getmtime(path)))
+        with db:
+            db.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)', rows)
+            # an interrupted walk starts over at the next start
+            db.execute("INSERT OR REPLACE INTO state VALUES ('indexed')")
+
+    def sweep(self, db):
+        """ write recorded accesses, then evict until within the quota """
+        accesses, self.accesses = self.accesses, {}
+        forgotten, self.forgotten = self.forgotten, []
+        with db:
+            for key in forgotten:
+                db.execute('DELETE FROM tiles WHERE key = ?', (key,))
+            for (key, url), (size, atime) in accesses.items():
+                if size is None and db.execute('UPDATE tiles SET atime = ? '
+                    'WHERE key = ? AND url = ?', (atime, key, url)).rowcount:
+                    continue
+                if size is None:
+                    try:
+                        size = os.path.getsize(self.tile_cache.key_url(key, url))
+                    except OSError:
+                        continue
+                db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                    (key, url, size, atime))
+        self.bytes = db.execute('SELECT COALESCE(SUM(size), 0) FROM tiles').fetchone()[0]
+        while self.bytes > self.quota:
+            rows = db.execute('SELECT key, url, size FROM tiles ORDER BY atime '
+                'LIMIT ?', (self.batch,)).fetchall()
+            if not rows:
+                break
+            removed = []
+            for key, url, size in rows:
+                if self.bytes <= self.quota:
+                    break
+                try:
+                    os.remove(self.tile_cache.key_url(key, url))
+                    QUOTA_EVICTIONS.inc()
+                except OSError:
+                    pass
+                removed.append((key, url))
+                self.bytes -= size
+            with db:
+                db.executemany('DELETE FROM tiles WHERE key = ? AND url = ?', removed)
+
+class MemoryTileCache(object):
+    """ in-memory LRU of tile data in front of a TileCache, bounded by the
+    total size of the tiles it holds, so that hot tiles are served without
+    touching the disk. tiles are only kept in memory once they have been
+    read or written through the cache, and their validators with them """
+    def __init__(self, tile_cache, **kwargs):
+        self.tile_cache = tile_cache
+        self.tiles = OrderedDict()
+        self.validated = {}
+        self.size = kwargs.get('size', 64 * 1024 * 1024)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # local paths and directory handling are those of the disk cache
+        return getattr(self.tile_cache, name)
+
+    def remember(self, key, data):
+        """ store tile data as the most recently used tile """
+        if self.tiles.has_key(key):
+            self.forget(key)
+        if len(data) > self.size:
+            return
+        self.tiles[key] = data
+        self.bytes += len(data)
+        while self.bytes > self.size:
+            self.forget(next(iter(self.tiles)))
+
+    def forget(self, key):
+        """ drop a tile and its validators from memory """
+        self.bytes -= len(self.tiles.pop(key))
+        self.validated.pop(key, None)
+
+    def contains(self, mapfile, url):
+        return self.tiles.has_key((mapfile, url)) or \
+            self.tile_cache.contains(mapfile, url)
+
+    def set(self, mapfile, url, data):
+        self.remember((mapfile, url), data or '')
+        return self.tile_cache.set(mapfile, url, data)
+
+    def persist(self, mapfile, url, data):
+        self.remember((mapfile, url), data or '')
+        self.tile_cache.persist(mapfile, url, data)
+
+    def get(self, mapfile, url):
+        key = (mapfile, url)
+        if self.tiles.has_key(key):
+            self.hits += 1
+            data = self.tiles[key] = self.tiles.pop(key)
+            if self.tile_cache.quota:
+                self.tile_cache.quota.touch(self.tile_cache.key(mapfile), url)
+            return data
+        self.misses += 1
+        data = self.tile_cache.get(mapfile, url)
+        self.remember(key, data)
+        return data
+
+    def validators(self, mapfile, url):
+        key = (mapfile, url)
+        if self.validated.has_key(key):
+            return self.validated[key]
+        value = self.tile_cache.validators(mapfile, url)
+        if self.tiles.has_key(key):
+            self.validated[key] = value
+        return value
+
+    def set_generation(self, mapfile, generation):
+        if self.tile_cache.generation(mapfile) != generation:
+            for key in [key for key in self.tiles if key[0] == mapfile]:
+                self.forget(key)
+        self.tile_cache.set_generation(mapfile, generation)
+
+# Tile storage backends, by --tile_cache_backend name
+BACKENDS = {
+    'sqlite': sqlitestore.SQLiteStore
+}
+
 """
 PreCache handler for TL. Provides an asynchronous queue of shapefile requests
 corresponding to a given map. Once all shapefile requests have been made and
 unzipped, the callback function at PreCache.execute(callback) is called. A
-shared locking mechanism can be passed such that concurrent requests do not
-simultaneously download the same remote resources.
+shared registry of downloads in progress, keyed by URL, ensures that
+concurrent requests do not simultaneously download the same remote
+resources: later requests wait on the download already in flight and are
+resumed, or failed, together with it.
 """
+DOWNLOADS = {}
+
 class PreCache(TLCache):
     def __init__(self, **kwargs):
-        self.locks = kwargs.get('locks', [])
+        self.downloads = kwargs.get('downloads', DOWNLOADS)
         self.directory = kwargs['directory']
         self.request_handler = kwargs['request_handler']
+        self.errback = kwargs.get('errback', None)
         logging.info('running cache in %s' % self.directory)
         self.queue = []
+        self.pending = set()
+        self.downloading = {}
+        self.started = {}
+        self.failed = False
         self.callback = None
         self.kwargs = None
         if not os.path.isdir(self.directory): os.mkdir(self.directory)
@@ -114,116 +573,449 @@ class PreCache(TLCache):
         """ execute all requests and fire callback once completed """
         self.callback = callback
         self.kwargs = kwargs
-        for url in copy.copy(self.queue):
+        for url in self.queue:
             self.process_request(url)
-        if len(self.queue) == 0 and len(self.locks) == 0:
+        self.queue = []
+        if len(self.pending) == 0:
+            self.complete()
+
+    def complete(self):
+        """ fire the callback once all downloads are in. errors, such as a
+        mapfile that fails to compile, go to the errback if there is one """
+        try:
             self.callback(**self.kwargs)
+        except Exception, e:
+            if not self.errback:
+                raise
+            logging.exception('Could not load from %s', self.directory)
+            self.errback(e)
 
     def process_request(self, request_url):
         # Directory exists, request has already been successfully processed.
         base_dir = os.path.join(self.directory, safe64.dir(request_url))
         if os.path.isdir(base_dir):
-            if request_url in self.queue: self.queue.remove(request_url)
-            if request_url in self.locks: self.locks.remove(request_url)
-        # Request is in queue and not locked. Fire asynchronous HTTP request.
-        elif request_url in self.queue and request_url not in self.locks:
-            self.queue.remove(request_url)
-            self.locks.append(request_url)
+            return
+        # layers of a mapfile may share a datasource
+        if request_url in self.pending:
+            return
+        self.pending.add(request_url)
+        # Request is already being downloaded. Wait for it to complete.
+        if self.downloads.has_key(request_url):
+            self.downloads[request_url].append(self)
+        # Fire asynchronous HTTP request.
+        else:
+            self.downloads[request_url] = [self]
             logging.info("Locked: %s", request_url)
+            # stream the body to disk rather than holding it in memory
+            download = tempfile.NamedTemporaryFile(dir=self.directory,
+                prefix='.download-', delete=False)
+            self.downloading[request_url] = download
+            self.started[request_url] = time.time()
             http = tornado.httpclient.AsyncHTTPClient()
-            http.fetch(request_url, request_timeout=60, callback=self.cache)
-        # Request is in locks. Perform a holding pattern.
-        elif request_url in self.locks:
-            tornado.ioloop.IOLoop.instance().add_timeout(
-                time.time() + 5, lambda: self.process_request(request_url))
-        # All queued requests have been processed. Continue to callback.
-        if len(self.queue) == 0 and len(self.locks) == 0:
-            self.callback(**self.kwargs)
-        return
+            http.fetch(request_url, request_timeout=60, callback=self.cache,
+                streaming_callback=download.write)
 
-    def unzip_shapefile(self, zipdata, base_dir, request):
+    def resolve(self, request_url, error=None):
+        """ a download this precache was waiting on has completed """
+        self.pending.discard(request_url)
+        if self.failed:
+            return
+        if error is not None:
+            self.failed = True
+            if self.errback:
+                self.errback(error)
+            else:
+                self.request_handler.finish()
+        elif len(self.pending) == 0:
+            self.complete()
+
+    def unzip_shapefile(self, path, base_dir, request):
         """ unzip a shapefile into a directory, creating the directory
-        structure if it doesn't exist """
-        # try:
-        #     import pylzma
-        #     from py7zlib import Archive7z
-        #     zip_file = Archive7z(StringIO.StringIO(zipdata))
-        #     infos = zip_file.getnames()
-        # except ImportError:
+        structure if it doesn't exist. members are extracted in chunks into
+        a temporary directory that is renamed into place once complete """
+        parent = os.path.dirname(base_dir)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        extract_dir = tempfile.mkdtemp(dir=parent, prefix='.extract-')
         try:
-            zip_file = zipfile.ZipFile(StringIO.StringIO(zipdata))
-            infos = zip_file.infolist()
-        except Exception:
-            logging.info('File is not a zipfile')
-            if not os.path.isdir(base_dir):
-                os.makedirs(base_dir)
-            basename = os.path.basename(request.url)
-            file_name = os.path.normpath('%(base_dir)s/%(basename)s' % locals())
-            file = open(file_name, 'wb')
-            file.write(zipdata)
-            file.close()
-            return
+            try:
+                zip_file = zipfile.ZipFile(path)
+                infos = zip_file.infolist()
+            except Exception:
+                logging.info('File is not a zipfile')
+                basename = os.path.basename(request.url)
+                shutil.copyfile(path, os.path.normpath(
+                    '%(extract_dir)s/%(basename)s' % locals()))
+            else:
+                self.extract_shapefile(zip_file, infos, extract_dir)
+            try:
+                os.rename(extract_dir, base_dir)
+            except OSError:
+                if not os.path.isdir(base_dir):
+                    raise
+        finally:
+            # left behind if extraction failed or a concurrent job won
+            if os.path.isdir(extract_dir):
+                shutil.rmtree(extract_dir)
 
+    def extract_shapefile(self, zip_file, infos, extract_dir):
+        """ extract the parts of a shapefile from a zip """
         extensions = [os.path.splitext(info.filename)[1].lower() for info in infos]
         basenames  = [os.path.basename(info.filename).lower() for info in infos]
         # Caching only requires that .shp is present
         for (expected, required) in (('.shp', True), ('.shx', False), ('.dbf', False), ('.prj', False)):
             if required and expected not in extensions:
-                raise Exception('Zip file %(shapefile)s missing extension "%(expected)s"' % locals())
+                raise Exception('Zip file missing extension "%(expected)s"' % locals())
             for (info, extension, basename) in zip(infos, extensions, basenames):
                 if extension == expected:
-                    if not os.path.isdir(base_dir):
-                        os.makedirs(base_dir)
-                    try:
-                        # pylzma
-                        file_data = zip_file.getmember(info.filename).read()
-                    except:
-                        file_data = zip_file.read(info.filename)
-                    file_name = os.path.normpath('%(base_dir)s/%(basename)s' % locals())
-                    file = open(file_name, 'wb')
-                    file.write(file_data)
-                    file.close()
+                    file_name = os.path.normpath('%(extract_dir)s/%(basename)s' % locals())
+                    member = zip_file.open(info)
+                    with open(file_name, 'wb') as output:
+                        shutil.copyfileobj(member, output, 64 * 1024)
+                    member.close()
 
     def cache(self, response):
         """ asynchttp request callback. caches the downloaded zipfile. """
+        error = None
+        download = self.downloading.pop(response.request.url)
+        download.close()
+        DOWNLOAD_SECONDS.observe(time.time() - self.started.pop(response.request.url))
         try:
+            if response.error:
+                raise response.error
             # Check that the directory does not exist yet, as there *can* be
             # concurrent jobs at this point. Do not actually create the
             # directory until we are sure that a successful shapefile can be
             # extracted from a zip.
             base_dir = os.path.join(self.directory, safe64.dir(response.request.url))
             if not os.path.isdir(base_dir):
-                self.unzip_shapefile(response.body, base_dir, response.request)
+                with UNZIP_SECONDS.time():
+                    self.unzip_shapefile(download.name, base_dir, response.request)
+            logging.info("Unlocked: %s", response.request.url)
         except Exception, e:
             logging.info('Failed: %s', response.request.url)
             logging.info('Exception: %s', e)
-            if response.request.url in self.locks : self.locks.remove(response.request.url)
-            if response.request.url not in self.queue : self.queue.append(response.request.url)
-            self.request_handler.finish()
-            return
-        logging.info("Unlocked: %s", response.request.url)
-        if response.request.url in self.locks: self.locks.remove(response.request.url)
-        if len(self.queue) == 0 and len(self.locks) == 0:
-            self.callback(**self.kwargs)
+            DOWNLOAD_FAILURES.inc()
+            error = e
+        os.remove(download.name)
+        for waiter in self.downloads.pop(response.request.url, []):
+            waiter.resolve(response.request.url, error)
+
+class Reservation(object):
+    """ a place in the pool of a map for an instance yet to be loaded """
+
+def cascadenik_version():
+    """ the version of the installed cascadenik. compiled stylesheets are
+    only reused if compiled by the same version, so an unknown version
+    raises rather than let stylesheets of another version be reused """
+    version = getattr(cascadenik, '__version__', None)
+    if version is None:
+        import pkg_resources
+        version = pkg_resources.get_distribution('cascadenik').version
+    return str(version)
+
+CASCADENIK_VERSION = cascadenik_version()
 
 class MapCache(TLCache):
-    """ mapfile and mapnik map cache """
+    """ mapfile and mapnik map cache
+
+    Loaded maps are kept in least-recently-used order and evicted once
+    either the entry count exceeds `size` or the estimated footprint of
+    the cached maps exceeds `memory` bytes (0 disables the byte ceiling).
+    Maps that are checked out by a running callback are never evicted.
+
+    Compiled stylesheets are kept on disk under compiled/, named by a hash
+    of the mapfile and the cascadenik version, so that a map is only
+    compiled again when either changes.
+
+    The number of times each map was requested is kept in requests.json,
+    so that the most popular maps can be loaded ahead of their requests
+    after a restart. Requests are counted once their map is ready, maps
+    loaded without a request are not counted, and only the `tracked` most
+    requested maps are kept.
+
+    Given a tile_cache, the tiles of each map are versioned by the same
+    hash, so that tiles of an earlier version of a mapfile are never served.
+    revalidate() downloads cached mapfiles again if they changed upstream,
+    which loads their maps again and, given a tile_cache, starts a new
+    generation of their tiles.
+    Given a field_index, the field statistics of a map are forgotten along
+    with the map.
+
+    For renderers that run jobs in threads, each map also has a pool of up
+    to `pool` independent instances loaded from its compiled stylesheet,
+    checked out with acquire() and returned with release(). A pool grows
+    with the number of jobs of its map running at once, and shrink() trims
+    it to the peak concurrency since the last call, keeping at least one
+    instance until the map is evicted.
+    """
     def __init__(self, **kwargs):
         self.directory = kwargs['directory']
-        self.mapnik_maps = {}
-        self.mapnik_locks = {}
+        self.tile_cache = kwargs.get('tile_cache', None)
+        self.field_index = kwargs.get('field_index', None)
+        self.digests = {}
+        self.mapnik_maps = OrderedDict()
+        self.mapnik_sizes = {}
+        self.mapnik_users = {}
+        self.prepared = set()
+        self.refreshing = set()
+        self.etags = {}
+        self.loaded = {}
         self.size = kwargs.get('size', 10)
+        self.memory = kwargs.get('memory', 0)
         self.tilesize = kwargs.get('tilesize', 256)
+        self.pool = kwargs.get('pool', 1)
+        self.pools = OrderedDict()
+        self.instances = {}
+        self.demand = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tracked = kwargs.get('tracked', 1000)
         if not os.path.isdir(self.directory): os.mkdir(self.directory)
+        self.requests = self.load_requests()
 
     def compile(self, url, compile_callback):
         """ retrieve and compile a mapnik xml file. only called when the map
         is not already in static cache. calls compile_callback when  """
-        self.mapnik_maps[url] = mapnik.Map(self.tilesize, self.tilesize)
-        open("%s_compiled.xml" % self.filecache(url), 'w').write(
-            cascadenik.compile(self.filecache(url), urlcache=True))
-        mapnik.load_map(self.mapnik_maps[url], "%s_compiled.xml" % self.filecache(url))
-        compile_callback(self.mapnik_maps[url])
+        # another request may have compiled the map while this one was
+        # waiting on its datasources
+        if not self.mapnik_maps.has_key(url):
+            self.load_map(url)
+        self.checkout(url, compile_callback)
+
+    def digest(self, path):
+        """ hash of a mapfile and the cascadenik version, recomputed only
+        when the size or modification time of the mapfile changes """
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        if self.digests.get(path, (None,))[0] != key:
+            with open(path, 'rb') as f:
+                self.digests[path] = (key, hashlib.sha1(
+                    f.read() + CASCADENIK_VERSION).hexdigest())
+        return self.digests[path][1]
+
+    def compiled(self, url, recompile=False):
+        """ path of the compiled stylesheet of a mapfile, compiling it
+        unless an up-to-date compilation is on disk """
+        path = self.filecache(url)
+        compiled_dir = os.path.join(self.directory, 'compiled')
+        compiled = os.path.join(compiled_dir, '%s.xml' % self.digest(path))
+        if recompile or not os.path.isfile(compiled):
+            if not os.path.isdir(compiled_dir):
+                os.makedirs(compiled_dir)
+            output = tempfile.NamedTemporaryFile(dir=compiled_dir,
+                prefix='.compile-', delete=False)
+            try:
+                with COMPILE_SECONDS.time():
+                    output.write(cascadenik.compile(path, urlcache=True))
+                output.close()
+                os.rename(output.name, compiled)
+            finally:
+                if os.path.isfile(output.name):
+                    os.remove(output.name)
+        return compiled
+
+    def load_map(self, url):
+        """ compile a mapfile and load it into the static cache """
+        mapnik_map = mapnik.Map(self.tilesize, self.tilesize)
+        compiled = self.compiled(url)
+        try:
+            with LOAD_SECONDS.time():
+                mapnik.load_map(mapnik_map, compiled)
+        except RuntimeError:
+            # the datasources that a stored compilation refers to may have
+            # been cleaned up since. compile them again once.
+            logging.info('Recompiling %s', url)
+            mapnik_map = mapnik.Map(self.tilesize, self.tilesize)
+            compiled = self.compiled(url, recompile=True)
+            with LOAD_SECONDS.time():
+                mapnik.load_map(mapnik_map, compiled)
+        self.mapnik_maps[url] = mapnik_map
+        self.mapnik_sizes[url] = self.estimate_size(mapnik_map, compiled)
+        self.loaded[url] = self.digest(self.filecache(url))
+        self.version(url)
+        self.evict(keep=url)
+        return mapnik_map
+
+    def clone(self, url):
+        """ load another instance of a map for its pool. called by render
+        threads for a Reservation, off the IOLoop """
+        mapnik_map = mapnik.Map(self.tilesize, self.tilesize)
+        compiled = self.compiled(url)
+        with LOAD_SECONDS.time():
+            mapnik.load_map(mapnik_map, compiled)
+        if not self.mapnik_sizes.has_key(url):
+            self.mapnik_sizes[url] = self.estimate_size(mapnik_map, compiled)
+        return mapnik_map
+
+    def acquire(self, url):
+        """ check out an instance of a map from its pool for the exclusive
+        use of one job. if all are in use, a Reservation is returned for an
+        instance to be loaded with clone(). returns None once the pool is
+        at its size and every instance is in use """
+        idle = self.pools.setdefault(url, [])
+        instances = self.instances.setdefault(url, [])
+        if not idle and len(instances) >= self.pool:
+            return None
+        # mark as most recently used
+        self.pools[url] = self.pools.pop(url)
+        self.mapnik_users[url] = self.mapnik_users.get(url, 0) + 1
+        if idle:
+            instance = idle.pop()
+        else:
+            instance = Reservation()
+            instances.append(instance)
+        self.demand[url] = max(self.demand.get(url, 0),
+            len(instances) - len(idle))
+        return instance
+
+    def release(self, url, instance, mapnik_map=None):
+        """ return an instance checked out with acquire() to its pool,
+        unless the map was removed in the meantime. for a Reservation, the
+        loaded mapnik_map takes its place, or None if loading failed """
+        self.mapnik_users[url] -= 1
+        if not self.mapnik_users[url]:
+            del self.mapnik_users[url]
+        instances = self.instances.get(url, [])
+        if not [m for m in instances if m is instance]:
+            return
+        if isinstance(instance, Reservation):
+            instances.remove(instance)
+            if mapnik_map is None:
+                return
+            instances.append(mapnik_map)
+            instance = mapnik_map
+            self.evict(keep=url)
+        self.pools[url].append(instance)
+
+    def shrink(self):
+        """ drop idle instances beyond the peak number of instances of each
+        map in use since the last call, keeping at least one """
+        for url, idle in self.pools.items():
+            instances = self.instances[url]
+            while idle and len(instances) > max(self.demand.get(url, 0), 1):
+                mapnik_map = idle.pop()
+                instances[:] = [m for m in instances if m is not mapnik_map]
+            self.demand[url] = len(instances) - len(idle)
+
+    def drop_pool(self, url):
+        """ forget the pool of a map. instances still in use are not
+        returned to it """
+        self.pools.pop(url, None)
+        self.instances.pop(url, None)
+        self.demand.pop(url, None)
+        if not self.mapnik_maps.has_key(url):
+            self.mapnik_sizes.pop(url, None)
+
+    def load(self, url):
+        """ get a mapnik.Map object from a URL of a map.xml file without an
+        IOLoop, compiling it synchronously if it is not cached. a map is
+        loaded again once another process replaced its mapfile """
+        if self.mapnik_maps.has_key(url) and \
+            self.loaded.get(url) != self.digest(self.filecache(url)):
+            self.drop(url)
+        if self.mapnik_maps.has_key(url):
+            self.hits += 1
+            self.mapnik_maps[url] = self.mapnik_maps.pop(url)
+            return self.mapnik_maps[url]
+        self.misses += 1
+        return self.load_map(url)
+
+    def estimate_size(self, mapnik_map, compiled):
+        """ estimate the resident size of a loaded map in bytes, from the
+        compiled stylesheet and the on-disk size of its file datasources """
+        size = os.path.getsize(compiled)
+        for layer in mapnik_map.layers:
+            path = layer.datasource.params().as_dict().get('file', None)
+            if not path:
+                continue
+            stem = os.path.splitext(str(path))[0]
+            for extension in ('', '.shp', '.shx', '.dbf', '.index'):
+                if os.path.isfile(stem + extension):
+                    size += os.path.getsize(stem + extension)
+        return size
+
+    def footprint(self):
+        """ total estimated size of all cached maps in bytes """
+        return sum(size * (self.mapnik_maps.has_key(url) +
+            len(self.instances.get(url, []))) for url, size in self.mapnik_sizes.items())
+
+    def entries(self):
+        """ the number of maps cached, whether loaded or pooled """
+        return len(set(self.mapnik_maps.keys()) | set(self.pools.keys()))
+
+    def evict(self, keep=None):
+        """ drop least-recently-used maps until the cache is within its
+        entry count and memory ceiling. maps in use are skipped """
+        candidates = self.mapnik_maps.keys() + \
+            [url for url in self.pools if not self.mapnik_maps.has_key(url)]
+        for url in candidates:
+            if self.entries() <= self.size and \
+                (not self.memory or self.footprint() <= self.memory):
+                break
+            if url == keep or self.mapnik_users.get(url, 0):
+                continue
+            self.mapnik_maps.pop(url, None)
+            self.drop_pool(url)
+            self.mapnik_sizes.pop(url, None)
+            self.evictions += 1
+            logging.info('Evicted map %s', url)
+
+    def checkout(self, url, callback):
+        """ fire a callback with a cached map, protecting the map from
+        eviction for the duration of the callback """
+        self.mapnik_users[url] = self.mapnik_users.get(url, 0) + 1
+        try:
+            callback(self.mapnik_maps[url])
+        finally:
+            self.mapnik_users[url] -= 1
+            if not self.mapnik_users[url]:
+                del self.mapnik_users[url]
+
+    def load_requests(self):
+        """ request counts per mapfile saved by an earlier process """
+        try:
+            with open(os.path.join(self.directory, 'requests.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_requests(self):
+        """ write the request counts of the most requested mapfiles to disk """
+        if len(self.requests) > self.tracked:
+            self.requests = dict((url, self.requests[url])
+                for url in self.popular(self.tracked))
+        output = tempfile.NamedTemporaryFile(dir=self.directory,
+            prefix='.requests-', delete=False)
+        json.dump(self.requests, output)
+        output.close()
+        os.rename(output.name, os.path.join(self.directory, 'requests.json'))
+
+    def counted(self, url, request_handler, callback):
+        """ wrap the callback of a request for a map so that the request is
+        counted once the map is ready """
+        if request_handler is None:
+            # prewarming and seeding are not requests
+            return callback
+        def count(*args):
+            self.requests[url] = self.requests.get(url, 0) + 1
+            callback(*args)
+        return count
+
+    def popular(self, n):
+        """ the n most requested mapfiles """
+        return sorted(self.requests, key=self.requests.get, reverse=True)[:n]
+
+    def stats(self):
+        """ hit, miss and eviction counters along with current usage """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': self.entries(),
+            'bytes': self.footprint()
+        }
 
     def mapfile_datasources(self, url):
         """ parse a map.xml file and return the urls of all file-based datasources """
@@ -240,38 +1032,128 @@ class MapCache(TLCache):
                     if scheme != '':
                         yield parameter.text
 
-    def get(self, url, request_handler, callback):
+    def get(self, url, request_handler, callback, errback=None):
         """ get a mapnik.Map object from a URL of a map.xml file, 
-        regardless of cache status """
+        regardless of cache status. errback is called if a datasource
+        fails to download, otherwise the request is finished """
+        callback = self.counted(url, request_handler, callback)
         if not self.mapnik_maps.has_key(url):
-            if not self.mapnik_locks.has_key(url):
-                self.mapnik_locks[url] = []
+            self.misses += 1
             precache = PreCache(directory=tempfile.gettempdir(), 
                 request_handler=request_handler, 
-                locks=self.mapnik_locks[url])
+                errback=errback)
             [precache.add(ds_url) for ds_url in self.mapfile_datasources(url)]
             precache.execute(self.compile, url=url, compile_callback=callback)
         else:
-            callback(self.mapnik_maps[url])
+            self.hits += 1
+            # mark as most recently used
+            self.mapnik_maps[url] = self.mapnik_maps.pop(url)
+            self.checkout(url, callback)
 
-    def remove(self, url):
-        """ remove a map file, object and associated tiles from the cache """
+    def prepare(self, url, request_handler, callback, errback=None):
+        """ download the datasources of a map.xml file without loading the
+        map, for maps that are rendered by another process """
+        callback = self.counted(url, request_handler, callback)
+        if url in self.prepared:
+            callback()
+            return
+        precache = PreCache(directory=tempfile.gettempdir(), 
+            request_handler=request_handler, 
+            errback=errback)
+        [precache.add(ds_url) for ds_url in self.mapfile_datasources(url)]
+        precache.execute(self.prepared_callback, url=url, callback=callback)
+
+    def prepared_callback(self, url, callback):
+        self.prepared.add(url)
+        self.version(url)
+        callback()
+
+    def version(self, url):
+        """ switch the tiles of a mapfile to the generation of its
+        current content """
+        if self.tile_cache:
+            self.tile_cache.set_generation(url,
+                self.digest(self.filecache(url))[:16])
+
+    def refresh(self, url, conditional=False):
+        """ download a mapfile again in the background, replacing the
+        cached copy only once the download is complete. a conditional
+        download is skipped by the server if the mapfile did not change
+        since it was last downloaded """
+        if url in self.refreshing:
+            return
+        self.refreshing.add(url)
+        headers = {}
+        path = os.path.join(self.directory, url)
+        if conditional and os.path.isfile(path):
+            headers['If-Modified-Since'] = email.utils.formatdate(
+                os.stat(path).st_mtime, usegmt=True)
+            if url in self.etags:
+                headers['If-None-Match'] = self.etags[url]
+        http = tornado.httpclient.AsyncHTTPClient()
+        http.fetch(tornado.httpclient.HTTPRequest(self.fs2url(url),
+                headers=headers, request_timeout=60),
+            callback=lambda response: self.refreshed(url, response))
+
+    def revalidate(self):
+        """ check every cached mapfile for changes upstream """
+        for url in self.mapfiles():
+            self.refresh(url, conditional=True)
+
+    def refreshed(self, url, response):
+        """ refresh callback. if the mapfile changed, its map is loaded
+        again and its tiles are invalidated """
+        self.refreshing.discard(url)
+        if response.code == 304:
+            return
+        if response.error:
+            logging.error('Could not download %s again: %s', url, response.error)
+            return
+        path = os.path.join(self.directory, url)
+        previous = os.path.isfile(path) and self.digest(path) or None
+        output = tempfile.NamedTemporaryFile(dir=self.directory,
+            prefix='.mapfile-', delete=False)
         try:
-            # remove the object and data files
-            if self.mapnik_maps.has_key(url):
-                del self.mapnik_maps[url]
-            if self.mapnik_locks.has_key(url):
-                del self.mapnik_locks[url]
-            if os.path.isdir(os.path.join(self.directory, url)):
-                shutil.rmtree(os.path.join(self.directory, url))
-        except Exception:
-            return False
+            output.write(response.body)
+            output.close()
+            os.rename(output.name, path)
+        finally:
+            if os.path.isfile(output.name):
+                os.remove(output.name)
+        self.digests.pop(path, None)
+        if response.headers.get('Etag'):
+            self.etags[url] = response.headers.get('Etag')
+        if self.digest(path) != previous:
+            logging.info('Mapfile %s changed', url)
+            self.drop(url)
+            self.version(url)
+
+    def drop(self, url):
+        """ forget the loaded maps of a mapfile """
+        self.mapnik_maps.pop(url, None)
+        self.mapnik_sizes.pop(url, None)
+        self.loaded.pop(url, None)
+        self.drop_pool(url)
+        self.prepared.discard(url)
+        if self.field_index:
+            self.field_index.forget(url)
+
+    def remove(self, url):
+        """ remove a map object from the cache and download its mapfile
+        again. if the mapfile changed, its tiles are invalidated """
+        self.drop(url)
+        self.refresh(url)
+
+    def mapfiles(self):
+        """ return the filenames of cached mapfiles """
+        # mapfiles are named in base64, which has no dots, unlike the
+        # other files kept in the directory
+        return [x for x in os.listdir(self.directory) if
+            os.path.isfile(os.path.join(self.directory, x)) and '.' not in x]
 
     def list(self):
         """ return a list of cached URLs """
-        return map(self.fs2url, 
-              [x for x in os.listdir(self.directory) if 
-                os.path.isfile(os.path.join(self.directory, x))])
+        return map(self.fs2url, self.mapfiles())
 
 if __name__ == "__main__":
     import doctest
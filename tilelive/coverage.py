@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+try:
+    import mapnik2 as mapnik
+except ImportError:
+    import mapnik
+
+import fields
+
+"""
+
+Data coverage of a map, for seeding only the tiles that can hold data.
+Coverage is described by (minx, miny, maxx, maxy) envelopes in the srs of
+the map, either one per layer or one per feature. Feature envelopes are
+bucketed into a quadtree of tiles, descending from each tile only into
+the children that intersect one of the envelopes in its bucket.
+
+"""
+
+def transform(mapnik_map, layer):
+    """ a transform from the srs of a layer to that of its map, or None """
+    if layer.srs == mapnik_map.srs:
+        return None
+    return mapnik.ProjTransform(mapnik.Projection(layer.srs),
+        mapnik.Projection(mapnik_map.srs))
+
+def bounds(envelope):
+    return (envelope.minx, envelope.miny, envelope.maxx, envelope.maxy)
+
+def layer_envelope(mapnik_map, layer):
+    """ the extent of a layer in the srs of the map """
+    t = transform(mapnik_map, layer)
+    e = layer.envelope()
+    return bounds(t.forward(e) if t else e)
+
+def layer_envelopes(mapnik_map):
+    return [layer_envelope(mapnik_map, layer) for layer in mapnik_map.layers]
+
+def feature_envelopes(mapnik_map):
+    """ the extent of every feature of every layer in the srs of the map.
+    features are read one at a time, and only their extents are kept """
+    for layer in mapnik_map.layers:
+        t = transform(mapnik_map, layer)
+        for feature in fields.stream(layer.datasource.features(
+            mapnik.Query(layer.envelope()))):
+            e = feature.envelope()
+            yield bounds(t.forward(e) if t else e)
+
+def intersects(a, b):
+    return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]
+
+def covered_tiles(envelopes, minZoom, maxZoom, merc):
+    """ yield (z, {x: set of y}) for every zoom level from minZoom to
+    maxZoom, holding the tiles that intersect one of the envelopes """
+    world = [e for e in envelopes if intersects(e, merc.xyz_to_bounds(0, 0, 0))]
+    level = world and {(0, 0): world} or {}
+    for z in range(0, maxZoom + 1):
+        if z >= minZoom:
+            columns = {}
+            for x, y in level:
+                columns.setdefault(x, set()).add(y)
+            yield z, columns
+        if z == maxZoom:
+            break
+        children = {}
+        for (x, y), bucket in level.items():
+            for child in ((2*x, 2*y), (2*x+1, 2*y), (2*x, 2*y+1), (2*x+1, 2*y+1)):
+                tile = merc.xyz_to_bounds(child[0], child[1], z + 1)
+                inside = [e for e in bucket if intersects(e, tile)]
+                if inside:
+                    children[child] = inside
+        level = children
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import os, json, hashlib, tempfile, time
+from collections import OrderedDict
+
+try:
+    import mapnik2 as mapnik
+except ImportError:
+    import mapnik
+
+"""
+
+Field statistics for the inspection endpoints. The statistics of a field
+of a layer, its minimum, maximum and sorted distinct values, are built
+in a single pass over the features of the layer and kept both in memory
+and on disk, so that paging through the values of a field does not read
+the datasource again. Statistics of file datasources are rebuilt once the
+size or modification time of the files changes; those of other
+datasources are only kept in memory, for `ttl` seconds. The statistics of
+a mapfile are forgotten when the map cache drops its map.
+
+"""
+
+def stream(featureset):
+    """ iterate over a featureset without first loading all features """
+    if featureset is None:
+        return
+    while True:
+        try:
+            feature = featureset.next()
+        except StopIteration:
+            return
+        if feature is None:
+            return
+        yield feature
+
+def signature(layer):
+    """ sizes and modification times of the files of a datasource, or
+    None if it is not file based """
+    path = layer.datasource.params().as_dict().get('file', None)
+    if not path:
+        return None
+    stem = os.path.splitext(str(path))[0]
+    files = [stem + extension for extension in ('', '.shp', '.shx', '.dbf')
+        if os.path.isfile(stem + extension)]
+    return [[f, os.path.getmtime(f), os.path.getsize(f)] for f in files]
+
+def statistics(layer, field):
+    """ min, max, distinct count and sorted distinct values of a field.
+    strings are compared by length for min and max """
+    query = mapnik.Query(layer.envelope())
+    query.add_property_name(field)
+    values = set()
+    low, high, key = None, None, None
+    for feature in stream(layer.datasource.features(query)):
+        value = dict(feature).get(field)
+        if key is None:
+            key = len if isinstance(value, basestring) else (lambda v: v)
+            low = high = value
+        elif key(value) < key(low):
+            low = value
+        elif key(value) > key(high):
+            high = value
+        values.add(value)
+    return {
+        'min': low,
+        'max': high,
+        'count': len(values),
+        'values': sorted(values)
+    }
+
+class FieldIndex(object):
+    """ statistics of fields by (mapfile, layer, field), in an LRU of
+    `size` entries backed by json files in `directory` """
+    def __init__(self, **kwargs):
+        self.directory = kwargs['directory']
+        self.size = kwargs.get('size', 16)
+        self.ttl = kwargs.get('ttl', 300)
+        self.entries = OrderedDict()
+
+    def path(self, key):
+        return os.path.join(self.directory,
+            '%s.json' % hashlib.sha1(repr(key)).hexdigest())
+
+    def load(self, key, current):
+        """ the stored statistics of a key, if still current """
+        try:
+            with open(self.path(key)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if entry['signature'] != current:
+            return None
+        return entry
+
+    def save(self, key, entry):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        output = tempfile.NamedTemporaryFile(dir=self.directory,
+            prefix='.fields-', delete=False)
+        json.dump(entry, output)
+        output.close()
+        os.rename(output.name, self.path(key))
+
+    def get(self, mapfile, layer_id, layer, field):
+        """ statistics of a field of a layer of a mapfile """
+        key = (mapfile, layer_id, field)
+        current = signature(layer)
+        entry = self.entries.pop(key, None)
+        if entry is not None and current is None and \
+            time.time() - entry['built'] > self.ttl:
+            entry = None
+        if entry is None or entry['signature'] != current:
+            entry = current and self.load(key, current)
+            if not entry:
+                entry = statistics(layer, field)
+                entry['signature'] = current
+                entry['built'] = time.time()
+                if current:
+                    self.save(key, entry)
+        self.entries[key] = entry
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def forget(self, mapfile):
+        """ drop the statistics of the layers of a mapfile from memory.
+        stored statistics are checked against their files when loaded """
+        for key in [key for key in self.entries if key[0] == mapfile]:
+            del self.entries[key]
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+import struct
+
+try:
+    import mapnik2 as mapnik
+except ImportError:
+    import mapnik
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+
+Grid engines for TileLive. The engines sample a tile every `step` pixels
+in rows from the top left and return one cell per sample point, holding
+the join field values of every feature that a mapnik point query hits at
+the point. The query engine queries every point. The batch engine
+fetches the features of the tile with a single datasource query and
+hit tests all sample points against their geometries at once with NumPy,
+the way mapnik's point queries do, so that both build the same cells.
+A grid is the list of all those values, with '' for points that hit
+nothing, which is the input to the run-length encoding of grid tiles. A
+keyed grid holds one code per cell instead, in the manner of UTFGrid.
+
+"""
+
+def sample_points(mapnik_map, size=256, step=4):
+    """ map coordinates of the sample columns and rows of the current
+    extent, computed the same way as mapnik's own pixel transform """
+    e = mapnik_map.envelope()
+    sx = float(mapnik_map.width) / (e.maxx - e.minx)
+    sy = float(mapnik_map.height) / (e.maxy - e.miny)
+    xs = [e.minx + px / sx for px in range(0, size, step)]
+    ys = [e.maxy - py / sy for py in range(0, size, step)]
+    return xs, ys
+
+def query_cells(mapnik_map, join_field, size=256, step=4, layer=0):
+    """ build cells with one query_map_point call per sample point """
+    cells = []
+    for y in range(0, size, step):
+        for x in range(0, size, step):
+            featureset = mapnik_map.query_map_point(layer,x,y)
+            cells.append([feature[join_field] for feature in featureset.features])
+    return cells
+
+def layer_query(envelope, resolution, join_field):
+    """ a datasource query for a box that loads the join field """
+    try:
+        query = mapnik.Query(envelope, (resolution, resolution))
+    except TypeError:
+        query = mapnik.Query(envelope)
+    query.add_property_name(join_field)
+    return query
+
+# mapnik hit tests points within 3 pixels of a single vertex geometry
+TOLERANCE = 3
+
+# sample points times path edges hit tested at once
+CHUNK = 1 << 18
+
+def wkb_paths(wkb, offset=0):
+    """ the geometries of a WKB geometry, as mapnik holds them: one path
+    per point, line or polygon, each a list of (xs, ys) vertex arrays of
+    its rings. returns the paths and the offset after the geometry """
+    order = wkb[offset:offset + 1] == '\x00' and '>' or '<'
+    kind = struct.unpack_from(order + 'I', wkb, offset + 1)[0] % 1000
+    offset += 5
+    if kind == 1:
+        vertices = numpy.frombuffer(wkb, order + 'f8', 2, offset)
+        return [[(vertices[0::2], vertices[1::2])]], offset + 16
+    count = struct.unpack_from(order + 'I', wkb, offset)[0]
+    offset += 4
+    if kind == 2:
+        vertices = numpy.frombuffer(wkb, order + 'f8', 2 * count, offset)
+        return [[(vertices[0::2], vertices[1::2])]], offset + 16 * count
+    if kind == 3:
+        rings = []
+        for i in range(count):
+            n = struct.unpack_from(order + 'I', wkb, offset)[0]
+            vertices = numpy.frombuffer(wkb, order + 'f8', 2 * n, offset + 4)
+            rings.append((vertices[0::2], vertices[1::2]))
+            offset += 4 + 16 * n
+        return [rings], offset
+    if kind in (4, 5, 6, 7):
+        paths = []
+        for i in range(count):
+            parts, offset = wkb_paths(wkb, offset)
+            paths.extend(parts)
+        return paths, offset
+    raise ValueError('Unsupported WKB geometry type %d' % kind)
+
+def feature_paths(feature):
+    """ the paths of the geometries of a feature """
+    paths = []
+    for geometry in feature.geometries():
+        paths.extend(wkb_paths(geometry.to_wkb(mapnik.wkbByteOrder.NDR))[0])
+    return paths
+
+def hit_test(path, px, py, tolerance):
+    """ which of the points px, py hit a path, computed as mapnik's
+    hit_test does: the even-odd rule over every edge of every ring, or
+    the distance to the vertex of a path of a single vertex """
+    if sum(len(xs) for xs, ys in path) == 1:
+        xs, ys = [ring for ring in path if len(ring[0])][0]
+        return numpy.sqrt((px - xs[0]) ** 2 + (py - ys[0]) ** 2) <= abs(tolerance)
+    inside = numpy.zeros(len(px), bool)
+    x, y = px[:, numpy.newaxis], py[:, numpy.newaxis]
+    step = max(1, CHUNK // max(len(px), 1))
+    for xs, ys in path:
+        for start in range(0, len(xs) - 1, step):
+            # x0, y0 is the previous vertex and x1, y1 the current one
+            end = min(start + step, len(xs) - 1)
+            x0, y0 = xs[start:end], ys[start:end]
+            x1, y1 = xs[start + 1:end + 1], ys[start + 1:end + 1]
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                crossed = (((y1 <= y) & (y < y0)) | ((y0 <= y) & (y < y1))) & \
+                    (x < (x0 - x1) * (y - y1) / (y0 - y1) + x1)
+            inside ^= (crossed.sum(axis=1) % 2).astype(bool)
+    return inside
+
+def batch_cells(mapnik_map, join_field, size=256, step=4, layer=0):
+    """ build cells from a single datasource query for the tile, hit
+    testing all sample points against the geometries of each feature
+    whose bounds contain them in one pass, as query_map_point does for
+    a point. returns None if the layer cannot be handled without
+    per-point queries """
+    if numpy is None or not hasattr(mapnik, 'wkbByteOrder'):
+        return None
+    xs, ys = sample_points(mapnik_map, size, step)
+    l = mapnik_map.layers[layer]
+    e = mapnik_map.envelope()
+    if l.srs != mapnik_map.srs:
+        # sample points and the extent are taken to the layer projection
+        # one by one, like query_map_point does
+        transform = mapnik.ProjTransform(mapnik.Projection(l.srs),
+            mapnik.Projection(mapnik_map.srs))
+        points = [transform.backward(mapnik.Coord(x, y)) for y in ys for x in xs]
+        px = numpy.array([p.x for p in points])
+        py = numpy.array([p.y for p in points])
+        minx = transform.backward(mapnik.Coord(e.minx, e.miny)).x
+        maxx = transform.backward(mapnik.Coord(e.maxx, e.maxy)).x
+    else:
+        px = numpy.tile(numpy.array(xs), len(ys))
+        py = numpy.repeat(numpy.array(ys), len(xs))
+        minx, maxx = e.minx, e.maxx
+    tolerance = (maxx - minx) / mapnik_map.width * TOLERANCE
+    envelope = mapnik.Box2d(px.min(), py.min(), px.max(), py.max())
+    featureset = l.datasource.features(layer_query(envelope,
+        float(mapnik_map.width) / (e.maxx - e.minx), join_field))
+
+    hits = [[] for i in range(len(px))]
+    for feature in (featureset.features if featureset else []):
+        # datasources only hand features whose bounds contain the point
+        # to the hit test
+        b = feature.envelope()
+        cells = numpy.nonzero((px >= b.minx) & (px <= b.maxx) &
+            (py >= b.miny) & (py <= b.maxy))[0]
+        if not len(cells):
+            continue
+        hit = numpy.zeros(len(cells), bool)
+        for path in feature_paths(feature):
+            hit |= hit_test(path, px[cells], py[cells], tolerance)
+        value = feature[join_field]
+        for cell in cells[hit]:
+            hits[cell].append(value)
+    return hits
+
+def feature_cells(mapnik_map, join_field, engine='batch', size=256, step=4):
+    """ build the cells of a tile with the given engine, falling back to
+    per-point queries where the batch engine does not apply """
+    cells = None
+    if engine == 'batch':
+        cells = batch_cells(mapnik_map, join_field, size, step)
+    if cells is None:
+        cells = query_cells(mapnik_map, join_field, size, step)
+    return cells
+
+def feature_grid(mapnik_map, join_field, engine='batch', size=256, step=4):
+    """ build the feature grid of a tile with the given engine """
+    fg = [] # feature grid
+    for values in feature_cells(mapnik_map, join_field, engine, size, step):
+        fg.extend(values or [''])
+    return fg
+
+def encode_key(code):
+    """ the character of a key code, skipping '"' and '\\' as UTFGrid does """
+    code += 32
+    if code >= 34:
+        code += 1
+    if code >= 92:
+        code += 1
+    return unichr(code)
+
+def keyed_grid(mapnik_map, join_field, engine='batch', size=256, step=4):
+    """ build a keyed grid of a tile: a list of the distinct join field
+    values, starting with '' for no feature, and one row of key codes per
+    row of cells. cells that hit several features take the last one,
+    which mapnik draws on top """
+    keys = ['']
+    codes = {'': 0}
+    columns = len(range(0, size, step))
+    rows = []
+    row = []
+    for values in feature_cells(mapnik_map, join_field, engine, size, step):
+        value = values[-1] if values else ''
+        if not codes.has_key(value):
+            codes[value] = len(keys)
+            keys.append(value)
+        row.append(encode_key(codes[value]))
+        if len(row) == columns:
+            rows.append(u''.join(row))
+            row = []
+    return {'grid': rows, 'keys': keys}
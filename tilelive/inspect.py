@@ -2,7 +2,7 @@
 
 import tornado
 from server import TileLive
-import safe64, cache, tempfile, os, logging
+import safe64, cache, coverage, tempfile, os, logging
 from tornado.escape import json_encode, json_decode
 from osgeo import ogr
 
@@ -25,6 +25,7 @@ class InspectValueHandler(tornado.web.RequestHandler, TileLive):
     """ sample data from each datasource referenced by a mapfile """
     @tornado.web.asynchronous
     def get(self, mapfile_64, layer_id_64, field_name_64):
+        self.mapfile_64 = mapfile_64
         self.layer_id   = safe64.decode(layer_id_64)
         self.field_name = safe64.decode(field_name_64)
         self.application._map_cache.get(mapfile_64, self, self.async_callback(self.async_get))
@@ -33,21 +34,20 @@ class InspectValueHandler(tornado.web.RequestHandler, TileLive):
         try:
             layer = self.layer_by_id(mapnik_map, self.layer_id)
 
-            field_values = [dict(f).get(self.field_name)
-                for f in layer.datasource.all_features()]
+            # statistics are built once per field and datasource version
+            stats = self.application._field_index.get(self.mapfile_64,
+                self.layer_id, layer, self.field_name)
 
             start = 0 + int(self.get_argument('start', 0))
             end = int(self.get_argument('limit', 30)) + \
                 int(self.get_argument('start', 0))
 
-            stringlen = {'key': len} if isinstance(field_values[0], basestring) else {}
-
             json = json_encode({
-                'min': min(field_values, **stringlen),
-                'max': max(field_values, **stringlen),
-                'count': len(set(field_values)),
+                'min': stats['min'],
+                'max': stats['max'],
+                'count': stats['count'],
                 'field': self.field_name,
-                'values': sorted(list(set(field_values)))[start:end]
+                'values': stats['values'][start:end]
             })
             self.jsonp(json, self.get_argument('jsoncallback', None))
         except IndexError:
@@ -128,16 +128,15 @@ class InspectFieldHandler(tornado.web.RequestHandler, TileLive):
               {
                 'fields': dict(zip(layer.datasource.fields(),
                 [field.__name__ for field in layer.datasource.field_types()])),
-                'extent': self.layer_envelope(layer)
+                'extent': self.layer_envelope(mapnik_map, layer)
               }
             ) for layer in mapnik_map.layers]))
         self.jsonp(json, self.get_argument('jsoncallback', None))
         self.finish()
 
-    def layer_envelope(self, layer):
+    def layer_envelope(self, mapnik_map, layer):
         """ given a layer object, return an envelope of it in merc """
-        e = layer.envelope()
-        return [e.minx, e.miny, e.maxx, e.maxy]
+        return list(coverage.layer_envelope(mapnik_map, layer))
 
 class InspectDataHandler(tornado.web.RequestHandler, TileLive):
     """ fields and field types of each datasource referenced by a mapfile """
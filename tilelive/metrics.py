@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import time, threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+"""
+
+Counters and latency histograms for TileLive, exposed in the Prometheus
+text format. Metrics are plain in-process dicts that are cheap to update
+from the IOLoop, and from render threads under a lock. Render worker
+processes drain their metrics after every job and send them along with
+the result, to be merged into the metrics of the server.
+
+"""
+
+# latency buckets in seconds
+BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class Counter(object):
+    """ a count by label values """
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, values):
+        for key, value in values.items():
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, key, value
+
+class Timer(object):
+    """ context manager that observes the time spent in its block """
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+class Histogram(object):
+    """ a distribution of observations in buckets, by label values """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def state(self, key):
+        """ bucket counts, sum and count of a set of label values """
+        if not self.values.has_key(key):
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        return self.values[key]
+
+    def observe(self, value, **labels):
+        with self.lock:
+            state = self.state(tuple(sorted(labels.items())))
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def merge(self, values):
+        for key, (counts, total, count) in values.items():
+            state = self.state(key)
+            state[0] = [a + b for a, b in zip(state[0], counts)]
+            state[1] += total
+            state[2] += count
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                yield self.name + '_bucket', key + (('le', bound),), cumulative
+            yield self.name + '_sum', key, total
+            yield self.name + '_count', key, count
+
+class Callback(object):
+    """ a value read from elsewhere when metrics are collected. the
+    function returns a number, or a dict of numbers by label tuples """
+    def __init__(self, name, help, kind, function):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for key, v in sorted(value.items()):
+            yield self.name, key, v
+
+class Registry(object):
+    """ metrics by name """
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        self.metrics.setdefault(metric.name, metric)
+        return self.metrics[metric.name]
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def callback(self, name, help, kind, function):
+        """ register a callback, replacing an earlier one of the same name """
+        self.metrics[name] = Callback(name, help, kind, function)
+
+    def drain(self):
+        """ take the values of all counters and histograms, resetting them """
+        drained = {}
+        for name, metric in self.metrics.items():
+            if isinstance(metric, (Counter, Histogram)) and metric.values:
+                with metric.lock:
+                    drained[name], metric.values = metric.values, {}
+        return drained
+
+    def merge(self, drained):
+        """ add drained values of another process """
+        for name, values in drained.items():
+            if self.metrics.has_key(name):
+                self.metrics[name].merge(values)
+
+    def render(self):
+        """ all metrics in the Prometheus text format """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, format_labels(labels),
+                    format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+callback = REGISTRY.callback
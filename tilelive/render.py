@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import os, tempfile, shutil
+
+import grid, metrics
+
+try:
+    import mapnik2 as mapnik
+except ImportError:
+    import mapnik
+
+"""
+
+Rendering routines for TileLive that operate on an already loaded
+mapnik.Map and return encoded tile data, independent of any request
+handler. Jobs only take plain, picklable arguments so that they can be
+run by a worker process as well as in the server itself.
+
+"""
+
+RENDER_SECONDS = metrics.histogram('tilelive_render_seconds',
+    'Time mapnik takes to render a job, without encoding')
+ENCODE_SECONDS = metrics.histogram('tilelive_encode_seconds',
+    'Time to encode rendered images')
+
+# mapnik encodes jpg tiles under the name of their codec
+FORMATS = {'jpg': 'jpeg'}
+
+def image_format(filetype):
+    """ mapnik image format name for a tile file extension """
+    return FORMATS.get(filetype, filetype)
+
+def prepare(mapnik_map, envelope, buffer_size):
+    """ zoom a map to a (minx, miny, maxx, maxy) envelope """
+    mapnik_map.zoom_to_box(mapnik.Box2d(*envelope))
+    mapnik_map.buffer_size = buffer_size
+
+def set_metawriter(mapnik_map, tile_dir, z, x, y):
+    """ point the metawriters of a map at the output of a tile """
+    # TODO: this makes dangerous assumptions about the content of the file string
+    mapnik_map.set_metawriter_property('tile_dir', tile_dir)
+    mapnik_map.set_metawriter_property('z', str(z))
+    mapnik_map.set_metawriter_property('x', str(x))
+    mapnik_map.set_metawriter_property('y', str(y))
+
+def render_features(mapnik_map, im, z, x, y):
+    """ render a map into an image, returning the metawriter output of the
+    tile z/x/y, or None if the map wrote none. the output goes to a scratch
+    directory, so that it never shows up in the tile cache half written """
+    scratch = tempfile.mkdtemp(prefix='tilelive-')
+    try:
+        os.makedirs(os.path.join(scratch, str(z), str(x)))
+        set_metawriter(mapnik_map, scratch, z, x, y)
+        mapnik.render(mapnik_map, im)
+        path = os.path.join(scratch, str(z), str(x), '%d.json' % y)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        shutil.rmtree(scratch, True)
+
+def render_tile(mapnik_map, envelope, buffer_size, filetype):
+    """ render a single tile """
+    prepare(mapnik_map, envelope, buffer_size)
+    im = mapnik.Image(mapnik_map.width, mapnik_map.height)
+    with RENDER_SECONDS.time(job='tile'):
+        mapnik.render(mapnik_map, im)
+    with ENCODE_SECONDS.time():
+        return im.tostring(image_format(filetype))
+
+def render_tile_data(mapnik_map, envelope, buffer_size, filetype, z, x, y):
+    """ render a single tile along with its metawriter output. returns
+    the tile and the data tile, if any """
+    prepare(mapnik_map, envelope, buffer_size)
+    im = mapnik.Image(mapnik_map.width, mapnik_map.height)
+    with RENDER_SECONDS.time(job='tile_data'):
+        features = render_features(mapnik_map, im, z, x, y)
+    with ENCODE_SECONDS.time():
+        return im.tostring(image_format(filetype)), features
+
+def render_metatile(mapnik_map, envelope, buffer_size, tilesize, cols, rows,
+    filetype):
+    """ render a block of cols x rows tiles in one pass and slice it into
+    individual tiles. returns a dict of encoded tiles keyed by their
+    (column, row) offset from the top-left tile of the block """
+    width, height = mapnik_map.width, mapnik_map.height
+    mapnik_map.resize(tilesize * cols, tilesize * rows)
+    # metawriter output describes the whole block rather than a tile, so
+    # it goes to a scratch directory of this render and is thrown away
+    scratch = tempfile.mkdtemp(prefix='tilelive-')
+    try:
+        set_metawriter(mapnik_map, scratch, 'metatile', 'metatile', 'metatile')
+        prepare(mapnik_map, envelope, buffer_size)
+        im = mapnik.Image(tilesize * cols, tilesize * rows)
+        with RENDER_SECONDS.time(job='metatile'):
+            mapnik.render(mapnik_map, im)
+    finally:
+        mapnik_map.resize(width, height)
+        shutil.rmtree(scratch, True)
+    tiles = {}
+    with ENCODE_SECONDS.time():
+        for dx in range(cols):
+            for dy in range(rows):
+                view = im.view(dx * tilesize, dy * tilesize, tilesize, tilesize)
+                tiles[(dx, dy)] = view.tostring(image_format(filetype))
+    return tiles
+
+def render_grid(mapnik_map, envelope, buffer_size, join_field, engine):
+    """ build the feature grid of a tile """
+    prepare(mapnik_map, envelope, buffer_size)
+    with RENDER_SECONDS.time(job='grid'):
+        return grid.feature_grid(mapnik_map, join_field, engine)
+
+def render_keyed_grid(mapnik_map, envelope, buffer_size, join_field, engine):
+    """ build the keyed grid of a tile """
+    prepare(mapnik_map, envelope, buffer_size)
+    with RENDER_SECONDS.time(job='keyed_grid'):
+        return grid.keyed_grid(mapnik_map, join_field, engine)
+
+def render_data(mapnik_map, envelope, buffer_size, z, x, y):
+    """ render a tile for the sake of its metawriter output only """
+    prepare(mapnik_map, envelope, buffer_size)
+    im = mapnik.Image(mapnik_map.width, mapnik_map.height)
+    with RENDER_SECONDS.time(job='data'):
+        return render_features(mapnik_map, im, z, x, y)
+
+def warm(mapnik_map):
+    """ render nothing. used to load a map ahead of its requests """
+    return None
+
+# Render jobs by name, as requested from renderers
+JOBS = {
+    'tile': render_tile,
+    'tile_data': render_tile_data,
+    'metatile': render_metatile,
+    'grid': render_grid,
+    'keyed_grid': render_keyed_grid,
+    'data': render_data,
+    'warm': warm
+}
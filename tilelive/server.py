@@ -1,5 +1,7 @@
 #!/usr/bin/env python
-import os, logging, json
+import os, logging, json, base64, gzip, signal
+import email.utils
+from cStringIO import StringIO
 from exceptions import KeyError
 
 import tornado.httpclient
@@ -10,7 +12,7 @@ from tornado.escape import json_encode, json_decode
 from tornado.options import define, options
 
 from sphericalmercator import SphericalMercator
-import cache, safe64
+import cache, metrics, safe64, workers
 
 try:
     import mapnik2 as mapnik
@@ -34,10 +36,47 @@ define('tile_cache', default=True,
     help='enable development tile cache', type=bool)
 define('tile_cache_dir', default='tiles', 
     help='tile cache dir', type=str)
+define('tile_cache_backend', default='file', 
+    help='tile cache storage, file or sqlite (one SQLite database per map)', type=str)
+define('tile_memory_cache', default=0, 
+    help='size of the in-memory cache of hot tiles in megabytes (0 for none)', type=int)
+define('tile_cache_quota', default=0, 
+    help='size of the file tile cache in megabytes, beyond which the least recently used tiles are removed (0 for none)', type=int)
 define('map_cache_dir', default='mapfiles', 
     help='tile cache dir', type=str)
 define('point_query', default=True, 
     help='enable point query', type=bool)
+define('map_cache_size', default=10, 
+    help='maximum number of mapnik maps held in memory', type=int)
+define('map_cache_memory', default=0, 
+    help='memory ceiling for cached maps in megabytes (0 for none)', type=int)
+define('metatile', default=1, 
+    help='render tiles in blocks of NxN into the tile cache', type=int)
+define('grid_engine', default='batch', 
+    help='grid tile engine, batch (one datasource query per tile) or query (one query per cell)', type=str)
+define('grid_format', default='rle', 
+    help='grid tile format, rle or keyed (key codes per cell, stored gzipped)', type=str)
+define('render_workers', default=0, 
+    help='number of render worker processes (0 to render in the server)', type=int)
+define('render_threads', default=0, 
+    help='number of render threads in the server (0 to render on the IOLoop)', type=int)
+define('map_pool_size', default=4, 
+    help='instances of each map that render threads may use at once', type=int)
+define('mapfile_check', default=300, 
+    help='seconds between checks of cached mapfiles for changes upstream (0 to never check)', type=int)
+define('prewarm', default=0, 
+    help='number of the most requested maps to load at startup', type=int)
+define('warm_list', default='', 
+    help='file of mapfile URLs to load at startup, one per line', type=str)
+define('tile_max_age', default=0, 
+    help='seconds that clients may cache tiles without revalidating (0 to send no Cache-Control)', type=int)
+define('metrics', default=False, 
+    help='serve counters and latency histograms at /metrics', type=bool)
+
+TILE_CACHE_REQUESTS = metrics.counter('tilelive_tile_cache_requests_total',
+    'Tile, grid and data tile requests by tile cache result')
+COALESCED_REQUESTS = metrics.counter('tilelive_coalesced_requests_total',
+    'Requests that waited on an identical render already in flight')
 
 class TileLive(object):
     def rle_encode(self, l):
@@ -74,191 +113,351 @@ class TileLive(object):
         """ GridTiles now use predetermined callbacks that can be done on both sides """
         return "%s_%d_%d_%d" % (mapfile_64.replace('=', '_'), z, x, y)
 
-class DataTileHandler(tornado.web.RequestHandler, TileLive):
+    def async_error(self, e):
+        """ rendering failed and the map was reset by the renderer """
+        logging.error('Map for %s failed to render, cache reset', self.mapfile)
+        # Retry exactly once to re-render this tile.
+        if not hasattr(self, 'retry'):
+            self.retry = True
+            self.get(*self.route_args)
+        else:
+            self.land('send_error', 500)
+
+    def single_flight(self, key, start):
+        """ call start() to render, unless an identical render is already
+        in flight, in which case this handler waits for it to land """
+        flights = self.application._flights
+        if getattr(self, 'flight', None) != key:
+            if flights.has_key(key):
+                COALESCED_REQUESTS.inc()
+                flights[key].append(self)
+                return
+            flights[key] = []
+            self.flight = key
+        start()
+
+    def release_flight(self, method, *args):
+        """ end the render in flight of this handler, if any, finishing
+        every handler that waited on it with method(*args) """
+        waiters = self.application._flights.pop(getattr(self, 'flight', None), [])
+        self.flight = None
+        for waiter in waiters:
+            try:
+                getattr(waiter, method)(*args)
+            except Exception:
+                logging.exception('Could not respond to a coalesced request')
+
+    def land(self, method, *args):
+        """ finish every handler that waited on this handler's render with
+        method(*args), then this handler itself """
+        self.release_flight(method, *args)
+        try:
+            getattr(self, method)(*args)
+        except Exception:
+            # the client of this handler may be gone, its waiters are not
+            logging.exception('Could not respond to %s', self.request.uri)
+
+    def finish(self, chunk=None):
+        """ a handler that finishes without landing its render, on an
+        error or a cache hit of a retry, fails the handlers waiting on it.
+        only takes effect in handlers that list TileLive first """
+        try:
+            tornado.web.RequestHandler.finish(self, chunk)
+        finally:
+            self.release_flight('send_error', 500)
+
+    def respond(self, data, content_type, validated=False):
+        if not validated and self.not_modified():
+            return
+        self.set_header('Content-Type', content_type)
+        self.write(data)
+        self.finish()
+
+    def not_modified(self, suffix=''):
+        """ send the validators of the cached tile at cache_url, and finish
+        with 304 Not Modified if the client already holds the tile """
+        if not options.tile_cache or not getattr(self, 'cache_url', None):
+            return False
+        try:
+            etag, modified = self.application._tile_cache.validators(
+                self.mapfile, self.cache_url)
+        except (OSError, KeyError):
+            # the tile left the cache since it was rendered
+            return False
+        etag = '"%s%s"' % (etag, suffix)
+        self.set_header('ETag', etag)
+        self.set_header('Last-Modified', email.utils.formatdate(modified, usegmt=True))
+        if options.tile_max_age:
+            self.set_header('Cache-Control', 'max-age=%d' % options.tile_max_age)
+        match = self.request.headers.get('If-None-Match', None)
+        since = self.request.headers.get('If-Modified-Since', None)
+        if match is not None:
+            # intermediaries may weaken etags, which is fine for a GET
+            tags = [tag.strip().replace('W/', '', 1) for tag in match.split(',')]
+            fresh = etag in tags or '*' in tags
+        elif since is not None:
+            parsed = email.utils.parsedate_tz(since)
+            fresh = parsed is not None and modified <= email.utils.mktime_tz(parsed)
+        else:
+            fresh = False
+        if fresh:
+            self.set_status(304)
+            self.finish()
+        return fresh
+
+    def serve_cached(self, content_type, gzipped=False):
+        """ respond with the cached tile at cache_url, or render it once
+        more if it was removed since it was found in the cache """
+        tile_cache = self.application._tile_cache
+        try:
+            if gzipped:
+                self.respond_gzip(tile_cache.get(self.mapfile, self.cache_url),
+                    content_type)
+            elif self.not_modified():
+                # revalidated tiles are as much in use as served ones
+                tile_cache.touch(self.mapfile, self.cache_url)
+            else:
+                self.respond(tile_cache.get(self.mapfile, self.cache_url),
+                    content_type, validated=True)
+        except (IOError, OSError, KeyError):
+            # evicted by the quota, or its generation was replaced
+            logging.info('%s left the tile cache, rendering', self.cache_url)
+            self.uncached = True
+            self.get(*self.route_args)
+
+    def gzip_encode(self, data):
+        """ compress data with gzip """
+        output = StringIO()
+        f = gzip.GzipFile(fileobj=output, mode='wb')
+        f.write(data)
+        f.close()
+        return output.getvalue()
+
+    def respond_gzip(self, data, content_type):
+        """ respond with gzipped data, decompressing it for clients that
+        do not accept gzip """
+        self.set_header('Vary', 'Accept-Encoding')
+        accepted = 'gzip' in self.request.headers.get('Accept-Encoding', '')
+        # both encodings of a tile are validated alike, but carry their own etag
+        if self.not_modified(not accepted and '-identity' or ''):
+            return
+        if accepted:
+            self.set_header('Content-Encoding', 'gzip')
+        else:
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        self.respond(data, content_type, validated=True)
+
+    def grid_tile(self, mapfile, z, x, y, fg):
+        """ the jsonp grid tile of a feature grid """
+        code_string = self.fString(mapfile, z, x, y)
+        return "%s(%s)" % (code_string, {
+          'features': str('|'.join(self.rle_encode(fg))),
+          'code_string': code_string
+        })
+
+    def keyed_grid_tile(self, mapfile, z, x, y, grid):
+        """ the gzipped jsonp grid tile of a keyed grid """
+        code_string = self.fString(mapfile, z, x, y)
+        grid['code_string'] = code_string
+        return self.gzip_encode("%s(%s)" % (code_string, json_encode(grid)))
+
+    def data_tile(self, features):
+        """ the jsonp data tile of this tile from its metawriter output """
+        code_string = self.fString(self.mapfile, self.z, self.x, self.y)
+        return "%s(%s)" % (code_string, json_encode({
+          'features': json_decode(str(features)),
+          'code_string': code_string}))
+
+    def cached(self, kind, url):
+        """ whether the tile cache holds a tile, counting hits and misses """
+        if not options.tile_cache:
+            return False
+        self.cache_url = url
+        if getattr(self, 'uncached', False):
+            return False
+        hit = self.application._tile_cache.contains(self.mapfile, url)
+        TILE_CACHE_REQUESTS.inc(kind=kind, result=hit and 'hit' or 'miss')
+        return hit
+
+class DataTileHandler(TileLive, tornado.web.RequestHandler):
     """ serve GeoJSON tiles created by metawriters """
     @tornado.web.asynchronous
     def get(self, layout, mapfile_64, z, x, y, filetype):
+        self.route_args = (layout, mapfile_64, z, x, y, filetype)
         self.z, self.x, self.y = map(int, [z, x, y])
         self.filetype = filetype
-        self.mapfile_64 = mapfile_64
-        code_string = self.fString(self.mapfile_64, self.z, self.x, self.y)
-        if options.tile_cache and self.application._tile_cache.contains(self.mapfile_64, 
-            "%d/%d/%d.%s" % (self.z, self.x, self.y, self.filetype)):
-            self.set_header('Content-Type', 'text/javascript')
-            self.write(self.application._tile_cache.get(self.mapfile_64, 
-                "%d/%d/%d.%s" % (self.z, self.x, self.y, self.filetype)))
-            self.finish()
+        self.mapfile = self.mapfile_64 = mapfile_64
+        if self.cached('data', "%d/%d/%d.%s" % (self.z, self.x, self.y, self.filetype)):
+            # a retry may find the tile cached by then
+            self.land('serve_cached', 'text/javascript')
             return
-        self.application._map_cache.get(mapfile, self, self.async_callback(self.async_get))
-
-    def async_get(self, mapnik_map):
-        envelope = self.application._merc.xyz_to_envelope(self.x, self.y, self.z)
-        mapnik_map.zoom_to_box(envelope)
-        mapnik_map.buffer_size = options.buffer_size
-        try:
-            # TODO: this makes dangerous assumptions about the content of the file string
-            mapnik_map.set_metawriter_property('tile_dir', 
-                self.application._tile_cache.local_dir(self.mapfile, ''))
-
-            mapnik_map.set_metawriter_property('z', str(self.z))
-            mapnik_map.set_metawriter_property('x', str(self.x))
-            mapnik_map.set_metawriter_property('y', str(self.y))
+        self.single_flight((self.mapfile, self.z, self.x, self.y, self.filetype),
+            self.render_data)
 
-            url = "%d/%d/%d.%s" % (self.z, self.x, self.y, 'png')
-            self.application._tile_cache.prepare_dir(self.mapfile, url)
-            code_string = self.fString(self.mapfile_64, self.z, self.x, self.y)
+    def render_data(self):
+        self.application._renderer.render(self.mapfile, self, 'data',
+            self.async_callback(self.async_get),
+            self.async_callback(self.async_error),
+            envelope=self.application._merc.xyz_to_bounds(self.x, self.y, self.z),
+            buffer_size=options.buffer_size,
+            z=self.z, x=self.x, y=self.y)
 
-            mapnik.render_to_file(mapnik_map, 
-                self.application._tile_cache.local_url(self.mapfile, url))
+    def async_get(self, features):
+        if features is None:
+            # the map has no metawriter for this tile
+            self.land('send_error', 404)
+            return
+        jsonp_str = self.data_tile(features)
+        self.application._tile_cache.persist(self.mapfile,
+          "%d/%d/%d.%s" % (self.z, self.x, self.y, self.filetype), jsonp_str)
+        self.land('respond', jsonp_str, 'text/javascript')
 
-            self.set_header('Content-Type', 'text/javascript')
-            code_string = self.fString(self.mapfile, self.z, self.x, self.y)
-            jsonp_str = "%s(%s)" % (code_string, json_encode({
-              'features': json_decode(str(self.application._tile_cache.get(self.mapfile, 
-                "%d/%d/%d.%s" % (self.z, self.x, self.y, 'json')))),
-              'code_string': code_string}))
-            self.application._tile_cache.set(self.mapfile,
-              "%d/%d/%d.%s" % (self.z, self.x, self.y, 'json'), jsonp_str)
-            self.write(self.application._tile_cache.get(self.mapfile_64, 
-                "%d/%d/%d.%s" % (self.z, self.x, self.y, self.filetype)))
-            self.finish()
-        except RuntimeError:
-            logging.error('Map for %s failed to render, cache reset', self.mapfile)
-            self.application._map_cache.remove(self.mapfile)
-            # Retry exactly once to re-render this tile.
-            if not hasattr(self, 'retry'):
-                self.retry = True
-                self.get(self.mapfile, self.z, self.x, self.y, self.filetype)
-
-class GridTileHandler(tornado.web.RequestHandler, TileLive):
+class GridTileHandler(TileLive, tornado.web.RequestHandler):
     """ serve gridded tile data """
     @tornado.web.asynchronous
     def get(self, layout, mapfile_64, z, x, y, join_field_64):
+        self.route_args = (layout, mapfile_64, z, x, y, join_field_64)
         self.z, self.x, self.y = map(int, [z, x, y])
         self.join_field_64 =join_field_64
         self.join_field = safe64.decode(join_field_64)
         self.filetype = 'grid.json'
-        self.mapfile_64 = mapfile_64
-        if options.tile_cache and self.application._tile_cache.contains(self.mapfile_64, 
-            "%d/%d/%d.%s.%s" % (self.z, self.x, self.y, self.join_field, self.filetype)):
+        self.mapfile = self.mapfile_64 = mapfile_64
+        if options.grid_format == 'keyed':
+            # keyed grids are stored gzipped, next to where rle grids are
+            self.filetype = 'grid.json.gz'
+            url = "%d/%d/%d.%s.%s" % (self.z, self.x, self.y,
+                self.join_field_64, self.filetype)
+            if self.cached('grid', url):
+                self.land('serve_cached', 'text/javascript', True)
+                return
+        elif self.cached('grid', "%d/%d/%d.%s.%s" % (self.z, self.x, self.y,
+            self.join_field_64, self.filetype)):
             logging.info('serving from cache')
-            self.set_header('Content-Type', 'text/javascript')
-            self.write(self.application._tile_cache.get(self.mapfile_64, 
-                "%d/%d/%d.%s.%s" % (self.z,
-                    self.x,
-                    self.y,
-                    self.join_field,
-                    self.filetype)))
-            self.finish()
+            self.land('serve_cached', 'text/javascript')
             return
-        self.application._map_cache.get(self.mapfile_64,
-                self,
-                self.async_callback(self.async_get))
-
-    def async_get(self, mapnik_map):
-        envelope = self.application._merc.xyz_to_envelope(self.x, self.y, self.z)
-        mapnik_map.zoom_to_box(envelope)
-        mapnik_map.buffer_size = options.buffer_size
-        code_string = self.fString(self.mapfile_64, self.z, self.x, self.y)
-        try:
-            fg = [] # feature grid
-            for y in range(0, 256, 4):
-                for x in range(0, 256, 4):
-                    featureset = mapnik_map.query_map_point(0,x,y)
-                    added = False
-                    for feature in featureset.features:
-                        fg.append(feature[self.join_field])
-                        added = True
-                    if not added:
-                        fg.append('')
-            jsonp_str = self.jsonp({
-              'features': str('|'.join(self.rle_encode(fg))),
-              'code_string': code_string
-            }, code_string)
-            logging.info('wrote jsonp')
-            json_url = "%d/%d/%d.%s.%s" % (self.z,
-                    self.x,
-                    self.y,
-                    self.join_field_64,
-                    self.filetype)
-            self.application._tile_cache.set(self.mapfile_64, json_url, jsonp_str)
-            self.finish()
-        except RuntimeError:
-            logging.error('Map for %s failed to render, cache reset', self.mapfile_64)
-            self.application._map_cache.remove(self.mapfile_64)
-            # Retry exactly once to re-render this tile.
-            if not hasattr(self, 'retry'):
-                self.retry = True
-                self.get(self.mapfile_64, self.z, self.x, self.y, self.filetype)
-
-class TileHandler(tornado.web.RequestHandler, TileLive):
+        self.single_flight((self.mapfile_64, self.z, self.x, self.y, self.join_field_64),
+            self.render_grid)
+
+    def render_grid(self):
+        keyed = options.grid_format == 'keyed'
+        self.application._renderer.render(self.mapfile_64, self,
+            keyed and 'keyed_grid' or 'grid',
+            self.async_callback(keyed and self.async_get_keyed or self.async_get),
+            self.async_callback(self.async_error),
+            envelope=self.application._merc.xyz_to_bounds(self.x, self.y, self.z),
+            buffer_size=options.buffer_size,
+            join_field=self.join_field,
+            engine=options.grid_engine)
+
+    def async_get(self, fg):
+        jsonp_str = self.grid_tile(self.mapfile_64, self.z, self.x, self.y, fg)
+        json_url = "%d/%d/%d.%s.%s" % (self.z,
+                self.x,
+                self.y,
+                self.join_field_64,
+                self.filetype)
+        self.application._tile_cache.persist(self.mapfile_64, json_url, jsonp_str)
+        self.land('respond', jsonp_str, 'text/javascript')
+
+    def async_get_keyed(self, grid):
+        data = self.keyed_grid_tile(self.mapfile_64, self.z, self.x, self.y, grid)
+        self.application._tile_cache.persist(self.mapfile_64,
+            "%d/%d/%d.%s.%s" % (self.z, self.x, self.y, self.join_field_64,
+                self.filetype), data)
+        self.land('respond_gzip', data, 'text/javascript')
+
+class TileHandler(TileLive, tornado.web.RequestHandler):
     """ handle all tile requests """
     @tornado.web.asynchronous
     def get(self, layout, mapfile, z, x, y, filetype):
+        self.route_args = (layout, mapfile, z, x, y, filetype)
         self.z, self.x, self.y = map(int, [z, x, y])
         self.filetype = filetype
         self.tms_style = (layout == 'tms')
         self.mapfile = mapfile
-        if options.tile_cache and self.application._tile_cache.contains(self.mapfile, 
-            "%d/%d/%d.%s" % (self.z, self.x, self.y, filetype)):
-            self.set_header('Content-Type', 'image/png')
-            self.write(self.application._tile_cache.get(self.mapfile, 
-                "%d/%d/%d.%s" % (self.z, self.x, self.y, self.filetype)))
-            self.finish()
+        if self.cached('tile', "%d/%d/%d.%s" % (self.z, self.x, self.y, filetype)):
+            self.land('serve_cached', 'image/png')
+            return
+        if options.tile_cache and options.metatile > 1:
+            self.render_metatile()
             return
-        self.application._map_cache.get(self.mapfile,
-                self,
-                self.async_callback(self.async_get))
+        self.single_flight((self.mapfile, self.z, self.x, self.y, self.filetype,
+            self.tms_style), self.render_tile)
 
-    def async_get(self, mapnik_map):
-        envelope = self.application._merc.xyz_to_envelope(self.x,
+    def render_tile(self):
+        envelope = self.application._merc.xyz_to_bounds(self.x,
                 self.y,
                 self.z,
                 self.tms_style)
-        mapnik_map.zoom_to_box(envelope)
-        mapnik_map.buffer_size = options.buffer_size
-        try:
-            if options.tile_cache:
-                mapnik_map.set_metawriter_property('tile_dir', 
-                    self.application._tile_cache.local_dir(self.mapfile, ''))
-                mapnik_map.set_metawriter_property('z', str(self.z))
-                mapnik_map.set_metawriter_property('x', str(self.x))
-                mapnik_map.set_metawriter_property('y', str(self.y))
-                url = "%d/%d/%d.%s" % (self.z, self.x, self.y, self.filetype)
-                self.application._tile_cache.prepare_dir(self.mapfile, url)
-                mapnik.render_to_file(mapnik_map, 
-                    self.application._tile_cache.local_url(self.mapfile, url))
-                if self.application._tile_cache.contains(self.mapfile, 
-                    "%d/%d/%d.%s" % (self.z, self.x, self.y, self.filetype)):
-                    self.set_header('Content-Type', 'image/png')
-                    self.write(self.application._tile_cache.get(self.mapfile, 
-                        "%d/%d/%d.%s" % (self.z, self.x, self.y, self.filetype)))
-                    if self.application._tile_cache.contains(self.mapfile, 
-                        "%d/%d/%d.%s" % (self.z, self.x, self.y, 'json')):
-                        code_string = self.fString(self.mapfile, self.z, self.x, self.y)
-                        jsonp_str = "%s(%s)" % (code_string, json_encode({
-                          'features': json_decode(str(self.application._tile_cache.get(self.mapfile, 
-                            "%d/%d/%d.%s" % (self.z, self.x, self.y, 'json')))),
-                          'code_string': code_string}))
-                        self.application._tile_cache.set(self.mapfile,
-                          "%d/%d/%d.%s" % (self.z, self.x, self.y, 'json'), jsonp_str)
-                    self.finish()
-                return
-            else:
-                im = mapnik.Image(options.tilesize, options.tilesize)
-                mapnik.render(mapnik_map, im)
-                self.set_header('Content-Type', 'image/png')
-                im_data = im.tostring('png')
-                self.write(im_data)
-                self.finish()
-            return
-        except RuntimeError:
-            logging.error('Map for %s failed to render, cache reset', self.mapfile)
-            self.application._map_cache.remove(self.mapfile)
-            # Retry exactly once to re-render this tile.
-            if not hasattr(self, 'retry'):
-                self.retry = True
-                self.get(self.mapfile, 'tms', self.z, self.x, self.y, self.filetype)
+        kwargs = {}
+        if options.tile_cache:
+            # the data tile is rendered along with the tile
+            kwargs = dict(z=self.z, x=self.x, y=self.y)
+        self.application._renderer.render(self.mapfile, self,
+            options.tile_cache and 'tile_data' or 'tile',
+            self.async_callback(self.async_get),
+            self.async_callback(self.async_error),
+            envelope=envelope,
+            buffer_size=options.buffer_size,
+            filetype=self.filetype,
+            **kwargs)
+
+    def async_get(self, result):
+        im_data = result
+        if options.tile_cache:
+            # respond right away, the tile cache writes to disk behind us
+            im_data, features = result
+            self.application._tile_cache.persist(self.mapfile,
+                "%d/%d/%d.%s" % (self.z, self.x, self.y, self.filetype), im_data)
+            if features is not None:
+                self.application._tile_cache.persist(self.mapfile,
+                    "%d/%d/%d.%s" % (self.z, self.x, self.y, 'json'),
+                    self.data_tile(features))
+        self.land('respond', im_data, 'image/png')
+
+    def render_metatile(self):
+        """ render the metatile containing this tile, store every tile of
+        it in the tile cache and return the data of the requested tile """
+        self.block, self.metatile, self.block_size = \
+            self.application._merc.metatile_to_bounds(self.x,
+                self.y,
+                self.z,
+                options.metatile,
+                self.tms_style)
+        self.single_flight((self.mapfile, self.z) + self.metatile +
+            ('metatile', self.filetype, self.tms_style), self.render_block)
+
+    def render_block(self):
+        cols, rows = self.block_size
+        # data tiles are rendered on their own by DataTileHandler
+        self.application._renderer.render(self.mapfile, self, 'metatile',
+            self.async_callback(self.async_get_metatile),
+            self.async_callback(self.async_error),
+            envelope=self.block,
+            buffer_size=options.buffer_size,
+            tilesize=options.tilesize,
+            cols=cols,
+            rows=rows,
+            filetype=self.filetype)
+
+    def async_get_metatile(self, tiles):
+        mx, my = self.metatile
+        for (dx, dy), data in tiles.items():
+            y = my - dy if self.tms_style else my + dy
+            self.application._tile_cache.persist(self.mapfile,
+                "%d/%d/%d.%s" % (self.z, mx + dx, y, self.filetype), data)
+        self.land('respond_metatile', tiles)
+
+    def respond_metatile(self, tiles):
+        """ respond with this handler's own tile out of a metatile """
+        mx, my = self.metatile
+        self.respond(tiles[(self.x - mx, abs(self.y - my))], 'image/png')
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ metrics in the Prometheus text format """
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.REGISTRY.render())
 
 class MainHandler(tornado.web.RequestHandler):
     """ home page, of little consequence """
@@ -275,17 +474,28 @@ class Application(tornado.web.Application):
         ]
 
         if options.inspect:
-            import inspect
+            import inspect, fields
             handlers.extend(inspect.handlers)
+            self._field_index = fields.FieldIndex(
+                directory=os.path.join(str(options.map_cache_dir), 'fields'))
 
         if options.point_query:
             import point_query
             handlers.extend(point_query.handlers)
 
+        if options.metrics:
+            handlers.append((r"/metrics", MetricsHandler))
+
         if options.tile_cache:
-            # since metawriters are only written on render_to_file, the
-            # tile cache must be enabled to use their output
-            self._tile_cache = cache.TileCache(directory=str(options.tile_cache_dir))
+            # data tiles are only served from the tile cache, so it must
+            # be enabled to use metawriter output
+            self._tile_cache = cache.TileCache(directory=str(options.tile_cache_dir),
+                backend=options.tile_cache_backend,
+                quota=options.tile_cache_quota * 1024 * 1024)
+            tornado.ioloop.PeriodicCallback(self._tile_cache.flush, 1000).start()
+            if options.tile_memory_cache:
+                self._tile_cache = cache.MemoryTileCache(self._tile_cache,
+                    size=options.tile_memory_cache * 1024 * 1024)
             handlers.extend([
               (r"/(zxy|tile)/([^/]+)/([0-9]+)/([0-9]+)/([0-9]+)\.(json)", DataTileHandler),
               (r"/(zxy|tile)/([^/]+)/([0-9]+)/([0-9]+)/([0-9]+)\.([^/\.]+)\.grid\.json", GridTileHandler)])
@@ -298,13 +508,124 @@ class Application(tornado.web.Application):
         tornado.web.Application.__init__(self, handlers, **settings)
         self._merc = SphericalMercator(levels=23, size=256)
         self._mercator = mapnik.Projection("+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs +over")
-        self._map_cache = cache.MapCache(directory=str(options.map_cache_dir))
+        map_cache_kwargs = dict(directory=str(options.map_cache_dir),
+            size=options.map_cache_size,
+            memory=options.map_cache_memory * 1024 * 1024)
+        self._map_cache = cache.MapCache(
+            tile_cache=options.tile_cache and self._tile_cache or None,
+            field_index=options.inspect and self._field_index or None,
+            pool=options.map_pool_size,
+            **map_cache_kwargs)
+        self._flights = {}
+        if options.render_workers:
+            self._renderer = workers.WorkerPool(self._map_cache,
+                options.render_workers, **map_cache_kwargs)
+        elif options.render_threads:
+            self._renderer = workers.ThreadedRenderer(self._map_cache,
+                options.render_threads)
+            tornado.ioloop.PeriodicCallback(self._map_cache.shrink, 60000).start()
+        else:
+            self._renderer = workers.InlineRenderer(self._map_cache)
+        tornado.ioloop.PeriodicCallback(self._map_cache.save_requests, 60000).start()
+        if options.mapfile_check:
+            # mapfiles kept from an earlier run are checked at startup too
+            tornado.ioloop.IOLoop.instance().add_callback(
+                self._map_cache.revalidate)
+            tornado.ioloop.PeriodicCallback(self._map_cache.revalidate,
+                options.mapfile_check * 1000).start()
+        self.register_metrics()
+        tornado.ioloop.IOLoop.instance().add_callback(
+            lambda: self.prewarm(self.warm_mapfiles()))
+
+    def register_metrics(self):
+        """ expose the counters that the caches keep themselves """
+        if not options.render_workers:
+            # with render workers, maps are cached in the workers and the
+            # map cache of the server only downloads datasources
+            self.register_map_cache_metrics()
+        if options.tile_cache and self._tile_cache.quota:
+            quota = self._tile_cache.quota
+            metrics.callback('tilelive_tile_cache_bytes',
+                'Size of the tiles in the tile cache, as of the last sweep', 'gauge',
+                lambda: quota.bytes)
+        if options.tile_cache and options.tile_memory_cache:
+            tile_cache = self._tile_cache
+            metrics.callback('tilelive_tile_memory_cache_hits_total',
+                'Tiles read from the in-memory tile cache', 'counter',
+                lambda: tile_cache.hits)
+            metrics.callback('tilelive_tile_memory_cache_misses_total',
+                'Tiles read from disk through the in-memory tile cache', 'counter',
+                lambda: tile_cache.misses)
+            metrics.callback('tilelive_tile_memory_cache_bytes',
+                'Size of the tiles held in memory', 'gauge',
+                lambda: tile_cache.bytes)
+
+    def register_map_cache_metrics(self):
+        """ expose the counters of the map cache """
+        map_cache = self._map_cache
+        metrics.callback('tilelive_map_cache_hits_total',
+            'Map requests served from the map cache', 'counter',
+            lambda: map_cache.hits)
+        metrics.callback('tilelive_map_cache_misses_total',
+            'Map requests that loaded a map', 'counter',
+            lambda: map_cache.misses)
+        metrics.callback('tilelive_map_cache_evictions_total',
+            'Maps evicted from the map cache', 'counter',
+            lambda: map_cache.evictions)
+        metrics.callback('tilelive_map_cache_maps',
+            'Maps held in the map cache', 'gauge',
+            lambda: len(map_cache.mapnik_maps))
+        metrics.callback('tilelive_map_cache_bytes',
+            'Estimated size of the maps held in the map cache', 'gauge',
+            map_cache.footprint)
+        metrics.callback('tilelive_map_pool_instances',
+            'Instances of maps in the pools of render threads', 'gauge',
+            lambda: sum(len(i) for i in map_cache.instances.values()))
+
+    def warm_mapfiles(self):
+        """ the mapfiles of the warm list followed by the most requested ones """
+        mapfiles = []
+        if options.warm_list:
+            try:
+                with open(options.warm_list) as f:
+                    mapfiles = [base64.urlsafe_b64encode(line.strip())
+                        for line in f if line.strip() and not line.startswith('#')]
+            except IOError, e:
+                logging.error('Could not read the warm list %s: %s',
+                    options.warm_list, e)
+        for mapfile in self._map_cache.popular(options.prewarm):
+            if mapfile not in mapfiles:
+                mapfiles.append(mapfile)
+        return mapfiles
+
+    def prewarm(self, mapfiles):
+        """ load maps one after another while serving requests, so that
+        their first requests do not wait for downloads and compilation """
+        if not mapfiles:
+            return
+        mapfile = mapfiles.pop(0)
+        logging.info('Prewarming %s', mapfile)
+        def proceed(result=None):
+            tornado.ioloop.IOLoop.instance().add_callback(
+                lambda: self.prewarm(mapfiles))
+        def failed(e):
+            logging.error('Could not prewarm %s: %s', mapfile, e)
+            proceed()
+        try:
+            self._renderer.render(mapfile, None, 'warm', proceed, failed)
+        except Exception, e:
+            failed(e)
 
 def main():
     tornado.options.parse_command_line()
     http_server = tornado.httpserver.HTTPServer(Application())
     http_server.listen(options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    ioloop = tornado.ioloop.IOLoop.instance()
+    # stop cleanly on SIGTERM, so that tiles still queued for the disk are
+    # written on exit
+    signal.signal(signal.SIGTERM,
+        lambda signum, frame: ioloop.add_callback(ioloop.stop))
+    ioloop.start()
 
 if __name__ == '__main__':
     main()
@@ -22,7 +22,10 @@ class SphericalMercator(object):
         self.DEG_TO_RAD = math.pi/180
         self.RAD_TO_DEG = 180/math.pi
         self.cache = {}
+        self.cache_size = 4096
         self.size = size
+        # half the circumference of the sphere, in projected meters
+        self.origin_shift = math.pi * 6378137
         for d in range(0,levels):
             e = size/2.0;
             self.Bc.append(size/360.0)
@@ -55,12 +58,35 @@ class SphericalMercator(object):
     
     def xyz_to_envelope(self,x,y,zoom,tms_style = False):
         """ Convert XYZ to mapnik.Envelope """
+        return mapnik.Box2d(*self.xyz_to_bounds(x, y, zoom, tms_style))
+
+    def xyz_to_bounds(self,x,y,zoom,tms_style = False):
+        """ Convert XYZ to a (minx, miny, maxx, maxy) tuple in projected
+        meters, computed directly rather than through lon/lat. results
+        are memoized """
+        key = (x, y, zoom, tms_style)
+        if key not in self.cache:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            if tms_style:
+                y = (2**zoom-1) - y
+            span = 2 * self.origin_shift / 2**zoom
+            minx = x * span - self.origin_shift
+            maxy = self.origin_shift - y * span
+            self.cache[key] = (minx, maxy - span, minx + span, maxy)
+        return self.cache[key]
+
+    def metatile_to_bounds(self,x,y,zoom,n,tms_style = False):
+        """ Find the block of up to n x n tiles containing XYZ. Returns the
+        bounds of the block along with its top-left tile (in the same
+        layout as the request) and its width and height in tiles """
         if tms_style:
             y = (2**zoom-1) - y
-        ll = (x * self.size,(y + 1) * self.size)
-        ur = ((x + 1) * self.size, y * self.size)
-        minx,miny = self.px_to_ll(ll,zoom)
-        maxx,maxy = self.px_to_ll(ur,zoom)
-        lonlat_bbox = mapnik.Box2d(minx,miny,maxx,maxy)
-        env = mercator.forward(lonlat_bbox)
-        return env
+        mx, my = x - x % n, y - y % n
+        cols, rows = min(n, 2**zoom - mx), min(n, 2**zoom - my)
+        tl = self.xyz_to_bounds(mx, my, zoom)
+        br = self.xyz_to_bounds(mx + cols - 1, my + rows - 1, zoom)
+        bounds = (tl[0], br[1], br[2], tl[3])
+        if tms_style:
+            my = (2**zoom-1) - my
+        return bounds, (mx, my), (cols, rows)
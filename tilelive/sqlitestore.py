@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import os, sqlite3, hashlib, time
+from collections import OrderedDict
+
+"""
+
+SQLite storage backend for the TileCache. Each mapfile gets a single
+database instead of a directory tree of small files. Tiles, grids and
+data tiles are kept by their tile url, so the databases are not MBTiles
+files and can only be served through TileLive. Writes are buffered and
+committed in batches, and databases are opened in WAL mode so that
+readers are not blocked while a batch is being written. The content hash
+and time of every tile are kept with it, as its HTTP validators.
+
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (url TEXT PRIMARY KEY, tile_data BLOB,
+    tile_etag TEXT, tile_time INTEGER);
+"""
+
+class SQLiteStore(object):
+    """ tile storage with one SQLite database per mapfile. at most `size`
+    databases are kept open, closing the least recently used one """
+    def __init__(self, directory, batch=100, size=64):
+        self.directory = directory
+        self.batch = batch
+        self.size = size
+        self.databases = OrderedDict()
+        self.pending = {}
+        self.count = 0
+
+    def path(self, mapfile):
+        return os.path.join(self.directory, '%s.sqlite' % mapfile)
+
+    def db(self, mapfile):
+        """ open or create the database of a mapfile """
+        if not self.databases.has_key(mapfile):
+            path = self.path(mapfile)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            db = sqlite3.connect(path)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(SCHEMA)
+            columns = [row[1] for row in db.execute('PRAGMA table_info(tiles)')]
+            if 'tile_etag' not in columns:
+                # databases written before validators were kept
+                db.execute('ALTER TABLE tiles ADD COLUMN tile_etag TEXT')
+                db.execute('ALTER TABLE tiles ADD COLUMN tile_time INTEGER')
+            self.databases[mapfile] = db
+            while len(self.databases) > self.size:
+                self.close(next(iter(self.databases)))
+        else:
+            # mark as most recently used
+            self.databases[mapfile] = self.databases.pop(mapfile)
+        return self.databases[mapfile]
+
+    def contains(self, mapfile, url):
+        if url in self.pending.get(mapfile, {}):
+            return True
+        return self.db(mapfile).execute('SELECT 1 FROM tiles WHERE url = ?',
+            (url,)).fetchone() is not None
+
+    def get(self, mapfile, url):
+        if url in self.pending.get(mapfile, {}):
+            return self.pending[mapfile][url][0]
+        row = self.db(mapfile).execute('SELECT tile_data FROM tiles WHERE url = ?',
+            (url,)).fetchone()
+        if row is None:
+            raise KeyError(url)
+        return str(row[0])
+
+    def validators(self, mapfile, url):
+        """ the (etag, modification time) of a tile """
+        if url in self.pending.get(mapfile, {}):
+            return self.pending[mapfile][url][1:]
+        row = self.db(mapfile).execute(
+            'SELECT tile_etag, tile_time FROM tiles WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            raise KeyError(url)
+        if row[0] is None:
+            return hashlib.md5(self.get(mapfile, url)).hexdigest(), \
+                int(os.path.getmtime(self.path(mapfile)))
+        return str(row[0]), row[1]
+
+    def set(self, mapfile, url, data):
+        """ queue a tile for the next batch, flushing full batches """
+        tiles = self.pending.setdefault(mapfile, {})
+        if url not in tiles:
+            self.count += 1
+        tiles[url] = (data or '', hashlib.md5(data or '').hexdigest(),
+            int(time.time()))
+        if self.count >= self.batch:
+            self.flush()
+
+    def write(self, mapfile, tiles):
+        db = self.db(mapfile)
+        with db:
+            db.executemany('INSERT OR REPLACE INTO tiles '
+                '(url, tile_data, tile_etag, tile_time) VALUES (?, ?, ?, ?)',
+                [(url, sqlite3.Binary(data), etag, modified)
+                    for url, (data, etag, modified) in tiles.items()])
+
+    def flush(self):
+        """ write all queued tiles, in one transaction per database """
+        for mapfile, tiles in self.pending.items():
+            self.write(mapfile, tiles)
+        self.pending = {}
+        self.count = 0
+
+    def close(self, mapfile):
+        """ write the queued tiles of a mapfile and close its database """
+        tiles = self.pending.pop(mapfile, None)
+        if tiles:
+            self.count -= len(tiles)
+            self.write(mapfile, tiles)
+        if self.databases.has_key(mapfile):
+            self.databases.pop(mapfile).close()
+
+    def files(self, mapfile):
+        """ the files of the database of a mapfile """
+        return [self.path(mapfile) + suffix for suffix in ('', '-wal', '-shm')]
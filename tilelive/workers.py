@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+import logging, itertools, multiprocessing, threading, time
+from collections import deque
+from functools import partial
+from Queue import Queue
+
+import tornado.ioloop
+
+import cache, metrics, render
+
+"""
+
+Renderers for TileLive. A renderer runs one of the jobs in render.JOBS
+against the map of a mapfile and hands the result to a callback, or a
+RuntimeError to an errback if rendering failed and the map was reset.
+
+InlineRenderer renders on the IOLoop thread with the application's
+MapCache. ThreadedRenderer runs jobs in threads, each on an instance of
+the map checked out of the pool of its mapfile in the MapCache, so that
+jobs for the same map render in parallel. WorkerPool sends jobs to
+worker processes that each own a MapCache, so that rendering never
+blocks the IOLoop. Jobs for a mapfile
+go to the workers that already have it loaded, and only spill over onto
+another worker once those are saturated. Workers send their metrics back
+with every result.
+
+"""
+
+JOB_SECONDS = metrics.histogram('tilelive_job_seconds',
+    'Time to run a render job on a loaded map, by job')
+
+class InlineRenderer(object):
+    """ render jobs in process, on the IOLoop thread """
+    def __init__(self, map_cache):
+        self.map_cache = map_cache
+
+    def render(self, mapfile, request_handler, job, callback, errback, **kwargs):
+        self.map_cache.get(mapfile, request_handler,
+            lambda mapnik_map: self.run(mapnik_map, mapfile, job,
+                callback, errback, kwargs),
+            lambda e: errback(RuntimeError(e)))
+
+    def run(self, mapnik_map, mapfile, job, callback, errback, kwargs):
+        try:
+            with JOB_SECONDS.time(job=job):
+                result = render.JOBS[job](mapnik_map, **kwargs)
+        except Exception, e:
+            logging.error('Job %s for %s failed: %s', job, mapfile, e)
+            self.map_cache.remove(mapfile)
+            errback(RuntimeError(e))
+            return
+        callback(result)
+
+class ThreadedRenderer(object):
+    """ render jobs in a pool of threads. jobs for a mapfile whose pool of
+    maps is exhausted wait for an instance to be released """
+    def __init__(self, map_cache, threads):
+        self.map_cache = map_cache
+        self.queue = Queue()
+        self.waiting = {}
+        self.ioloop = tornado.ioloop.IOLoop.instance()
+        for i in range(threads):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+
+    def render(self, mapfile, request_handler, job, callback, errback,
+        **kwargs):
+        self.map_cache.prepare(mapfile, request_handler,
+            lambda: self.dispatch(mapfile, request_handler, job, callback,
+                errback, kwargs),
+            lambda e: errback(RuntimeError(e)))
+
+    def dispatch(self, mapfile, request_handler, job, callback, errback,
+        kwargs):
+        """ hand a job to the threads with a map of its own """
+        instance = self.map_cache.acquire(mapfile)
+        if instance is None:
+            self.waiting.setdefault(mapfile, deque()).append(
+                (request_handler, job, callback, errback, kwargs))
+            return
+        self.queue.put((instance, mapfile, job, callback, errback, kwargs))
+
+    def run(self):
+        """ render thread: run jobs and hand results back to the IOLoop """
+        while True:
+            instance, mapfile, job, callback, errback, kwargs = \
+                self.queue.get()
+            mapnik_map, result, error = instance, None, None
+            start = time.time()
+            try:
+                # new instances are loaded here rather than on the IOLoop
+                if isinstance(instance, cache.Reservation):
+                    mapnik_map = None
+                    mapnik_map = self.map_cache.clone(mapfile)
+                result = render.JOBS[job](mapnik_map, **kwargs)
+            except Exception, e:
+                error = e
+            self.ioloop.add_callback(partial(self.land, instance, mapnik_map,
+                mapfile, job, callback, errback, result, error,
+                time.time() - start))
+
+    def land(self, instance, mapnik_map, mapfile, job, callback, errback,
+        result, error, seconds):
+        """ on the IOLoop: return the map to its pool and start a job that
+        waited on it, then hand over the result """
+        JOB_SECONDS.observe(seconds, job=job)
+        self.map_cache.release(mapfile, instance, mapnik_map)
+        if error is not None:
+            logging.error('Job %s for %s failed: %s', job, mapfile, error)
+            self.map_cache.remove(mapfile)
+        waiting = self.waiting.get(mapfile)
+        if waiting:
+            (request_handler, next_job, next_callback, next_errback,
+                kwargs) = waiting.popleft()
+            if not waiting:
+                del self.waiting[mapfile]
+            if mapfile in self.map_cache.prepared:
+                self.dispatch(mapfile, request_handler, next_job,
+                    next_callback, next_errback, kwargs)
+            else:
+                # a removed map is downloaded and prepared again first
+                self.render(mapfile, request_handler, next_job,
+                    next_callback, next_errback, **kwargs)
+        if error is not None:
+            errback(RuntimeError(error))
+        else:
+            callback(result)
+
+def worker(conn, map_cache_kwargs):
+    """ worker process loop: run jobs from the pipe until sent None """
+    map_cache = cache.MapCache(**map_cache_kwargs)
+    # forget the metrics of the server this process was forked from
+    metrics.REGISTRY.drain()
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        job_id, mapfile, job, kwargs = message
+        try:
+            mapnik_map = map_cache.load(mapfile)
+            with JOB_SECONDS.time(job=job):
+                result = render.JOBS[job](mapnik_map, **kwargs)
+            error = None
+        except Exception, e:
+            logging.error('Job %s for %s failed: %s', job, mapfile, e)
+            # the server downloads the mapfile again, which this worker
+            # picks up on its next load
+            map_cache.drop(mapfile)
+            result, error = None, str(e)
+        conn.send((job_id, result, error, metrics.REGISTRY.drain(),
+            map_cache.mapnik_maps.keys()))
+
+class WorkerPool(object):
+    """ render jobs in a pool of worker processes with mapfile affinity.
+    jobs wait in a backlog per worker and are sent one at a time, so that
+    neither side blocks on a full pipe """
+    def __init__(self, map_cache, workers, spill=4, **kwargs):
+        # the local map cache is only used to download datasources
+        # asynchronously before a job is handed to a worker
+        self.map_cache = map_cache
+        self.map_cache_kwargs = kwargs
+        self.spill = spill
+        self.jobs = {}
+        self.affinity = {}
+        self.counter = itertools.count()
+        self.workers = [None] * workers
+        self.pending = [0] * workers
+        self.backlogs = [deque() for i in range(workers)]
+        self.running = [None] * workers
+        for i in range(workers):
+            self.spawn(i)
+
+    def spawn(self, i):
+        """ start worker process i and listen for its results """
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=worker,
+            args=(child, self.map_cache_kwargs))
+        process.daemon = True
+        process.start()
+        child.close()
+        self.workers[i] = (process, parent)
+        tornado.ioloop.IOLoop.instance().add_handler(parent.fileno(),
+            lambda fd, events: self.receive(i),
+            tornado.ioloop.IOLoop.READ)
+
+    def choose(self, mapfile):
+        """ pick the least busy worker that has a mapfile loaded, spilling
+        onto the least busy worker overall once those are saturated """
+        loaded = self.affinity.setdefault(mapfile,
+            [hash(mapfile) % len(self.workers)])
+        i = min(loaded, key=lambda w: self.pending[w])
+        if self.pending[i] >= self.spill:
+            idle = min(range(len(self.workers)), key=lambda w: self.pending[w])
+            if self.pending[idle] < self.pending[i]:
+                loaded.append(idle)
+                i = idle
+        return i
+
+    def render(self, mapfile, request_handler, job, callback, errback, **kwargs):
+        self.map_cache.prepare(mapfile, request_handler,
+            lambda: self.dispatch(mapfile, job, callback, errback, kwargs),
+            lambda e: errback(RuntimeError(e)))
+
+    def dispatch(self, mapfile, job, callback, errback, kwargs):
+        i = self.choose(mapfile)
+        job_id = self.counter.next()
+        self.jobs[job_id] = (i, mapfile, callback, errback)
+        self.pending[i] += 1
+        self.backlogs[i].append((job_id, mapfile, job, kwargs))
+        self.feed(i)
+
+    def feed(self, i):
+        """ send worker i its next job, unless it is busy """
+        if self.running[i] is None and self.backlogs[i]:
+            message = self.backlogs[i].popleft()
+            self.running[i] = message[0]
+            self.workers[i][1].send(message)
+
+    def loaded(self, i, mapfiles):
+        """ forget the affinity of worker i for maps it no longer has """
+        mapfiles = set(mapfiles)
+        for mapfile, loaded in self.affinity.items():
+            if i in loaded and mapfile not in mapfiles:
+                loaded.remove(i)
+                if not loaded:
+                    del self.affinity[mapfile]
+
+    def receive(self, i):
+        """ IOLoop handler for results from worker i """
+        try:
+            job_id, result, error, worker_metrics, mapfiles = \
+                self.workers[i][1].recv()
+        except (EOFError, IOError):
+            self.restart(i)
+            return
+        metrics.REGISTRY.merge(worker_metrics)
+        mapfile, callback, errback = self.jobs.pop(job_id)[1:]
+        self.pending[i] -= 1
+        self.running[i] = None
+        self.loaded(i, mapfiles)
+        self.feed(i)
+        if error is not None:
+            self.map_cache.remove(mapfile)
+            errback(RuntimeError(error))
+        else:
+            callback(result)
+
+    def restart(self, i):
+        """ replace a worker process that died, failing its jobs """
+        logging.error('Render worker %d exited, restarting', i)
+        process, conn = self.workers[i]
+        tornado.ioloop.IOLoop.instance().remove_handler(conn.fileno())
+        conn.close()
+        failed = [job_id for job_id, job in self.jobs.items() if job[0] == i]
+        self.pending[i] = 0
+        self.backlogs[i].clear()
+        self.running[i] = None
+        self.spawn(i)
+        for job_id in failed:
+            self.jobs.pop(job_id)[3](RuntimeError('Render worker exited'))
+
+    def stop(self):
+        """ ask all workers to exit """
+        for process, conn in self.workers:
+            conn.send(None)
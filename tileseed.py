@@ -8,7 +8,7 @@ from Queue import Queue
 import threading
 from base64 import urlsafe_b64encode
 from urlparse import urlparse
-import httplib, time
+import httplib, socket, time, json
 
 """
 
@@ -19,7 +19,8 @@ import httplib, time
 DEG_TO_RAD = pi/180
 RAD_TO_DEG = 180/pi
 
-# Default number of rendering threads to spawn, should be roughly equal to number of CPU cores available
+# Default number of seeding threads to spawn, should be roughly equal to number of CPU cores available
+# across the TileLive backends being seeded
 NUM_THREADS = 2
 
 
@@ -59,25 +60,190 @@ class GoogleProjection:
          h = RAD_TO_DEG * ( 2 * atan(exp(g)) - 0.5 * pi)
          return (f,h)
 
+class SeedStats:
+    """ counts of seeded tiles shared by all render threads """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.ok = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def add(self, ok, size=0):
+        with self.lock:
+            if ok:
+                self.ok += 1
+                self.bytes += size
+            else:
+                self.failed += 1
+
+    def report(self):
+        elapsed = time.time() - self.start
+        return "%d tiles (%d failed), %.1f tiles/sec, %.1f KB/sec" % (
+            self.ok, self.failed,
+            (self.ok + self.failed) / elapsed if elapsed else 0,
+            self.bytes / 1024.0 / elapsed if elapsed else 0)
+
+class Checkpoint:
+    """ record of the (z, x) columns of a seed whose tiles all succeeded,
+    appended to a file so that an interrupted seed can resume. the file
+    starts with a line describing the seed and can only resume that seed """
+    def __init__(self, path, seed, interval=5):
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.done = set()
+        self.pending = {}
+        self.failed = set()
+        self.lines = []
+        self.last = time.time()
+        self.output = None
+        if not path:
+            return
+        header = "# %s\n" % seed
+        if os.path.isfile(path):
+            with open(path) as f:
+                if f.readline() != header:
+                    raise ValueError('checkpoint %s belongs to another seed' % path)
+                for line in f:
+                    try:
+                        z, x = map(int, line.split())
+                    except ValueError:
+                        # a line torn by an interrupted write
+                        continue
+                    self.done.add((z, x))
+            self.output = open(path, 'a')
+        else:
+            self.output = open(path, 'w')
+            self.output.write(header)
+
+    def __contains__(self, column):
+        return column in self.done
+
+    def begin(self, column, count):
+        """ expect count results for a column """
+        with self.lock:
+            self.pending[column] = count
+            if not count:
+                self.finish(column)
+
+    def complete(self, column, ok=True):
+        """ one result of a column is in """
+        with self.lock:
+            if not ok:
+                self.failed.add(column)
+            self.pending[column] -= 1
+            if not self.pending[column]:
+                self.finish(column)
+
+    def finish(self, column):
+        del self.pending[column]
+        if column in self.failed:
+            self.failed.discard(column)
+            return
+        self.done.add(column)
+        self.lines.append("%d %d\n" % column)
+        if time.time() - self.last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.last = time.time()
+        if self.output:
+            self.output.write(''.join(self.lines))
+            self.output.flush()
+        self.lines = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+        if self.output:
+            self.output.close()
+
+def cached(options, mapfile, url, tile_cache=None):
+    """ whether a tile exists in the tile cache and is younger than
+    --max-age. tiles of a storage backend have no age """
+    if tile_cache and tile_cache.store:
+        return tile_cache.contains(mapfile, url)
+    try:
+        mtime = os.path.getmtime(os.path.join(options.tile_cache_dir,
+            'tile', mapfile, url))
+    except OSError:
+        return False
+    return not options.max_age or time.time() - mtime < options.max_age
+
+def grid_file(options, url):
+    """ the name under which the server stores a grid tile """
+    if options.grid_format == 'keyed':
+        return url + '.gz'
+    return url
+
+def seed_description(bbox, minZoom, maxZoom, options):
+    """ identify a seed, for its checkpoint """
+    return "%s %s %d %d %s %s %s %s" % (options.mapfile, ','.join(map(str, bbox)),
+        minZoom, maxZoom, options.extension, options.grid, bool(options.tms),
+        options.coverage)
+
 class RenderThread:
-    def __init__(self, mapfile, url, q, printLock, maxZoom):
+    def __init__(self, mapfile, url, q, printLock, maxZoom, stats=None, verbose=False,
+        checkpoint=None):
         self.q = q
         self.printLock = printLock
+        self.stats = stats or SeedStats()
+        self.verbose = verbose
+        self.checkpoint = checkpoint or Checkpoint(None, None)
+        self.conn = None
         # Load style XML
         # Projects between tile pixel co-ordinates and LatLong (EPSG:4326)
         self.tileproj = GoogleProjection(maxZoom+1)
 
+    def connection(self, pts):
+        """ a keep-alive connection to the server, reused across tiles """
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(pts.hostname, pts.port, timeout=300)
+        return self.conn
+
+    def disconnect(self):
+        if self.conn:
+            self.conn.close()
+        self.conn = None
+
+    def fetch(self, pts):
+        """ the status and body of a GET over the persistent connection. a
+        reused connection that the server closed while it was idle is
+        opened again and the request sent once more """
+        while True:
+            reused = self.conn is not None
+            try:
+                conn = self.connection(pts)
+                conn.request('GET', pts.path)
+                resp = conn.getresponse()
+                return resp.status, resp.read()
+            except (httplib.HTTPException, socket.error), e:
+                self.disconnect()
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+
     def timed_transfer(self, path):
-        """ test a transfer by loading a file but not downloading it to anywhere """
+        """ request a tile over the thread's persistent connection, reading
+        and verifying the whole response """
         pts = urlparse(path)
-        conn = httplib.HTTPConnection(pts.hostname, pts.port)
         start = time.time()
-        conn.request('GET', pts.path)
-        request_time = time.time()
-        resp = conn.getresponse()
+        try:
+            status, body = self.fetch(pts)
+        except (httplib.HTTPException, socket.error), e:
+            self.stats.add(False)
+            with self.printLock:
+                print "%s failed: %s" % (path, e)
+            return False
         response_time = time.time()
-        conn.close()
-        print "%s took %.5f" % (path, (response_time - start))
+        ok = status == 200 and len(body) > 0
+        self.stats.add(ok, len(body))
+        if not ok:
+            with self.printLock:
+                print "%s failed: HTTP %d, %d bytes" % (path, status, len(body))
+        elif self.verbose:
+            with self.printLock:
+                print "%s took %.5f" % (path, (response_time - start))
+        return ok
 
     def loop(self):
         """ iterate through all necessary tiles, running timed_transfer for each """
@@ -89,8 +255,89 @@ class RenderThread:
                 break
             else:
                 (tile_uri, x, y, z) = r
-            self.timed_transfer(tile_uri)
+            self.checkpoint.complete((z, x), self.timed_transfer(tile_uri))
             self.q.task_done()
+        self.disconnect()
+
+def report_progress(stats, printLock, done, interval=5):
+    """ print seeding throughput every interval seconds until done is set """
+    while not done.wait(interval):
+        with printLock:
+            print stats.report()
+
+# half the circumference of the earth, in spherical mercator meters
+ORIGIN_SHIFT = pi * 6378137
+
+def tile_bounds(z, x, y):
+    """ the (minx, miny, maxx, maxy) of an xyz tile in spherical mercator
+    meters, as SphericalMercator.xyz_to_bounds computes them. seeding over
+    HTTP does not import tilelive, which needs mapnik """
+    span = 2 * ORIGIN_SHIFT / 2**z
+    minx = x * span - ORIGIN_SHIFT
+    maxy = ORIGIN_SHIFT - y * span
+    return (minx, maxy - span, minx + span, maxy)
+
+class Coverage:
+    """ where a map has data, either as a list of envelopes in spherical
+    mercator meters or as the covered tiles of every zoom level, keyed
+    by zoom and x """
+    def __init__(self, envelopes=None, tiles=None):
+        self.envelopes = envelopes
+        self.tiles = tiles
+
+    def column(self, z, x, ys):
+        """ the ys of a column of tiles that intersect data """
+        if self.tiles is not None:
+            covered = self.tiles.get(z, {}).get(x, ())
+            return [y for y in ys if y in covered]
+        minx, miny, maxx, maxy = tile_bounds(z, x, 0)
+        envelopes = [e for e in self.envelopes if e[0] <= maxx and e[2] >= minx]
+        column = []
+        for y in ys:
+            minx, miny, maxx, maxy = tile_bounds(z, x, y)
+            if any(e[1] <= maxy and e[3] >= miny for e in envelopes):
+                column.append(y)
+        return column
+
+def fetch_coverage(options):
+    """ layer envelopes from the fields.json inspection endpoint of a server """
+    pts = urlparse(options.url)
+    conn = httplib.HTTPConnection(pts.hostname, pts.port, timeout=300)
+    conn.request('GET', "%s/%s/fields.json" % (pts.path.rstrip('/'),
+        urlsafe_b64encode(options.mapfile)))
+    resp = conn.getresponse()
+    if resp.status != 200:
+        raise Exception('Could not inspect the layers of %s, HTTP %d '
+            '(is the server running with --inspect?)' % (options.mapfile, resp.status))
+    layers = json.loads(resp.read())
+    conn.close()
+    return Coverage(envelopes=[layer['extent'] for layer in layers.values()])
+
+def tile_columns(bbox, minZoom, maxZoom, coverage=None):
+    """ the tiles covering a bbox as (z, x, ys) columns, with y in the
+    xyz layout. with a coverage, only tiles that intersect data are
+    included """
+    gprj = GoogleProjection(maxZoom+1) 
+
+    ll0 = (bbox[0],bbox[3])
+    ll1 = (bbox[2],bbox[1])
+
+    for z in range(minZoom,maxZoom + 1):
+        px0 = gprj.fromLLtoPixel(ll0,z)
+        px1 = gprj.fromLLtoPixel(ll1,z)
+        # Validate y co-ordinates
+        ys = range(max(0, int(px0[1]/256.0)), min(2**z, int(px1[1]/256.0)+1))
+
+        for x in range(int(px0[0]/256.0),int(px1[0]/256.0)+1):
+            # Validate x co-ordinate
+            if (x < 0) or (x >= 2**z):
+                continue
+            if coverage:
+                column = coverage.column(z, x, ys)
+                if column:
+                    yield z, x, column
+            else:
+                yield z, x, ys
 
 def render_tiles(bbox, minZoom, maxZoom, options):
     mapfile = options.mapfile
@@ -98,67 +345,218 @@ def render_tiles(bbox, minZoom, maxZoom, options):
     print "render_tiles(",bbox, options.mapfile, options.url, ")"
 
     # Launch rendering threads
+    threads = options.threads
     queue = Queue(32)
     printLock = threading.Lock()
+    stats = SeedStats()
+    checkpoint = Checkpoint(options.checkpoint,
+        seed_description(bbox, minZoom, maxZoom, options))
     renderers = {}
-    for i in range(NUM_THREADS):
-        renderer = RenderThread(mapfile, url, queue, printLock, maxZoom)
+    for i in range(threads):
+        renderer = RenderThread(mapfile, url, queue, printLock, maxZoom,
+            stats, options.verbose, checkpoint)
         render_thread = threading.Thread(target=renderer.loop)
         render_thread.start()
         #print "Started render thread %s" % render_thread.getName()
         renderers[i] = render_thread
 
-    gprj = GoogleProjection(maxZoom+1) 
+    done = threading.Event()
+    reporter = threading.Thread(target=report_progress, args=(stats, printLock, done))
+    reporter.daemon = True
+    reporter.start()
 
-    ll0 = (bbox[0],bbox[3])
-    ll1 = (bbox[2],bbox[1])
+    mapfile_64 = urlsafe_b64encode(options.mapfile)
+    coverage = None
+    if options.coverage == 'envelope':
+        coverage = fetch_coverage(options)
+    for z, x, ys in tile_columns(bbox, minZoom, maxZoom, coverage):
+        if (z, x) in checkpoint:
+            continue
+        tiles = []
+        for y in ys:
+            if options.tms == True:
+                y = (2**z-1) - y
+            tiles.append(("%d/%d/%d.png" % (z, x, y), "%d/%d/%d.png" % (z, x, y), y))
+            if options.grid:
+                tile = "%d/%d/%d.%s.grid.json" % (z, x, y, urlsafe_b64encode(options.grid))
+                tiles.append((tile, grid_file(options, tile), y))
+        if options.skip_existing:
+            tiles = [(tile, stored, y) for tile, stored, y in tiles
+                if not cached(options, mapfile_64, stored)]
+        checkpoint.begin((z, x), len(tiles))
+        for tile, stored, y in tiles:
+            tile_uri = "%s/%s/%s/%s" % (
+                    url.rstrip('/'),
+                    'tile', # TODO: make customizable
+                    mapfile_64,
+                    tile)
 
-    for z in range(minZoom,maxZoom + 1):
-        px0 = gprj.fromLLtoPixel(ll0,z)
-        px1 = gprj.fromLLtoPixel(ll1,z)
-
-        for x in range(int(px0[0]/256.0),int(px1[0]/256.0)+1):
-            # Validate x co-ordinate
-            if (x < 0) or (x >= 2**z):
-                continue
-            for y in range(int(px0[1]/256.0),int(px1[1]/256.0)+1):
-                # Validate x co-ordinate
-                if (y < 0) or (y >= 2**z):
-                    continue
-                if options.tms == True:
-                    y = (2**z-1) - y
-                tile_uri = "%s/%s/%s/%d/%d/%d.png" % (
-                        url.rstrip('/'),
-                        'tile', # TODO: make customizable
-                        urlsafe_b64encode(options.mapfile),
-                        z,
-                        x,
-                        y)
-
-                # Submit tile to be rendered into the queue
-                print "requesting %s" % tile_uri
-                t = (tile_uri, x, y, z)
-                queue.put(t)
-                if options.grid:
-                    tile_uri = "%s/%s/%s/%d/%d/%d.%s.grid.json" % (
-                            url.rstrip('/'),
-                            'tile', # TODO: make customizable
-                            urlsafe_b64encode(options.mapfile),
-                            z,
-                            x,
-                            y,
-                            urlsafe_b64encode(options.grid))
-                    t = (tile_uri, x, y, z)
-                    print "requesting %s" % tile_uri
-                    queue.put(t)
+            # Submit tile to be rendered into the queue
+            t = (tile_uri, x, y, z)
+            queue.put(t)
 
     # Signal render threads to exit by sending empty request to queue
-    for i in range(NUM_THREADS):
+    for i in range(threads):
         queue.put(None)
     # wait for pending rendering jobs to complete
     queue.join()
-    for i in range(NUM_THREADS):
+    for i in range(threads):
         renderers[i].join()
+    done.set()
+    checkpoint.close()
+    print stats.report()
+
+"""
+
+Direct seeding renders tiles in worker processes that load the map
+themselves and write straight into the tile cache of a TileLive server,
+without going through HTTP. It needs mapnik and the tilelive package.
+
+"""
+
+# state of a direct seeding worker process, set up by init_direct
+DIRECT = {}
+
+def prepare_datasources(map_cache, mapfile):
+    """ download the datasources of a map the way the server does, before
+    any worker loads it """
+    import tornado.ioloop
+    ioloop = tornado.ioloop.IOLoop.instance()
+    errors = []
+    def errback(e):
+        errors.append(e)
+        ioloop.stop()
+    map_cache.prepare(mapfile, None, ioloop.stop, errback)
+    if mapfile not in map_cache.prepared and not errors:
+        ioloop.start()
+    if errors:
+        raise errors[0]
+
+def init_direct(options):
+    """ pool initializer: open the caches of a direct seeding worker and
+    load its map """
+    from tilelive import cache
+    from tilelive.sphericalmercator import SphericalMercator
+    from tilelive.server import TileLive
+    DIRECT['options'] = options
+    DIRECT['map_cache'] = cache.MapCache(directory=options.map_cache_dir,
+        tilesize=options.tilesize)
+    DIRECT['tile_cache'] = cache.TileCache(directory=options.tile_cache_dir,
+        backend=options.tile_cache_backend)
+    DIRECT['merc'] = SphericalMercator(levels=23, size=256)
+    DIRECT['tilelive'] = TileLive()
+    DIRECT['map'] = DIRECT['map_cache'].load(urlsafe_b64encode(options.mapfile))
+
+def render_direct(job):
+    """ pool task: render a range of tiles of one column into the tile
+    cache. returns the number of tiles rendered and failed """
+    from tilelive import render
+    z, x, ys, chunks = job
+    options = DIRECT['options']
+    tile_cache = DIRECT['tile_cache']
+    helpers = DIRECT['tilelive']
+    mapfile = urlsafe_b64encode(options.mapfile)
+    mapnik_map = DIRECT['map']
+    ok, failed = 0, 0
+    for y in ys:
+        bounds = DIRECT['merc'].xyz_to_bounds(x, y, z)
+        # tiles are stored under the y of the layout they are requested in
+        if options.tms:
+            y = (2**z-1) - y
+        tile = "%d/%d/%d.%s" % (z, x, y, options.extension)
+        grid = grid_file(options, "%d/%d/%d.%s.grid.json" % (z, x, y,
+            urlsafe_b64encode(options.grid or '')))
+        try:
+            if not (options.skip_existing and cached(options, mapfile, tile, tile_cache)):
+                tile_cache.set(mapfile, tile, render.render_tile(mapnik_map,
+                    bounds, options.buffer_size, options.extension))
+            if options.grid and not (options.skip_existing and
+                cached(options, mapfile, grid, tile_cache)):
+                if options.grid_format == 'keyed':
+                    tile_cache.set(mapfile, grid, helpers.keyed_grid_tile(
+                        mapfile, z, x, y, render.render_keyed_grid(mapnik_map,
+                            bounds, options.buffer_size, options.grid, 'batch')))
+                else:
+                    tile_cache.set(mapfile, grid, helpers.grid_tile(
+                        mapfile, z, x, y, render.render_grid(mapnik_map,
+                            bounds, options.buffer_size, options.grid, 'batch')))
+            ok += 1
+        except Exception, e:
+            print "%d/%d/%d failed: %s" % (z, x, y, e)
+            failed += 1
+    if not flush_direct(tile_cache):
+        # the column is seeded again when resuming from a checkpoint
+        ok, failed = 0, ok + failed
+    return z, x, chunks, ok, failed
+
+def flush_direct(tile_cache, attempts=5):
+    """ write the tiles a storage backend holds back, waiting for the
+    other seeding processes to release its database. returns whether the
+    tiles were written """
+    import sqlite3
+    for attempt in range(attempts):
+        try:
+            tile_cache.flush()
+            return True
+        except sqlite3.OperationalError, e:
+            print "flush failed (%s), retrying" % e
+            time.sleep(attempt + 1)
+    return False
+
+def direct_coverage(map_cache, mapfile, minZoom, maxZoom, method):
+    """ the coverage of a map from its layer or feature envelopes """
+    from tilelive import coverage
+    from tilelive.sphericalmercator import SphericalMercator
+    mapnik_map = map_cache.load(mapfile)
+    if method == 'envelope':
+        return Coverage(envelopes=coverage.layer_envelopes(mapnik_map))
+    return Coverage(tiles=dict(coverage.covered_tiles(
+        coverage.feature_envelopes(mapnik_map), minZoom, maxZoom,
+        SphericalMercator(levels=23, size=256))))
+
+def direct_jobs(bbox, minZoom, maxZoom, rows, checkpoint, coverage=None):
+    """ split the tiles of a bbox into jobs of up to rows tiles of a column,
+    leaving out columns that are already done """
+    for z, x, ys in tile_columns(bbox, minZoom, maxZoom, coverage):
+        if (z, x) in checkpoint:
+            continue
+        chunks = (len(ys) + rows - 1) / rows
+        for i in range(0, len(ys), rows):
+            yield z, x, ys[i:i + rows], chunks
+
+def seed_direct(bbox, minZoom, maxZoom, options):
+    """ render tiles into the tile cache with a pool of worker processes,
+    each of which loads the map once """
+    import multiprocessing
+    from tilelive import cache
+    print "seed_direct(",bbox, options.mapfile, options.tile_cache_dir, ")"
+    map_cache = cache.MapCache(directory=options.map_cache_dir)
+    prepare_datasources(map_cache, urlsafe_b64encode(options.mapfile))
+    # compile once here rather than in every worker at the same time
+    map_cache.compiled(urlsafe_b64encode(options.mapfile))
+    coverage = None
+    if options.coverage:
+        coverage = direct_coverage(map_cache, urlsafe_b64encode(options.mapfile),
+            minZoom, maxZoom, options.coverage)
+    pool = multiprocessing.Pool(options.threads, init_direct, (options,))
+    stats = SeedStats()
+    checkpoint = Checkpoint(options.checkpoint,
+        seed_description(bbox, minZoom, maxZoom, options))
+    last = time.time()
+    for z, x, chunks, ok, failed in pool.imap_unordered(render_direct,
+        direct_jobs(bbox, minZoom, maxZoom, options.rows, checkpoint, coverage)):
+        if (z, x) not in checkpoint.pending:
+            checkpoint.begin((z, x), chunks)
+        checkpoint.complete((z, x), not failed)
+        stats.ok += ok
+        stats.failed += failed
+        if time.time() - last >= 5:
+            last = time.time()
+            print stats.report()
+    pool.close()
+    pool.join()
+    checkpoint.close()
+    print stats.report()
 
 if __name__ == "__main__":
     """ run as a command-line tool """
@@ -176,16 +574,64 @@ if __name__ == "__main__":
     parser.add_option('-G', '--grid', dest='grid',
                       help='Grid join field')
 
+    parser.add_option('--grid_format', dest='grid_format', type='choice',
+                      choices=['rle', 'keyed'], default='rle',
+                      help='Grid format of the server, rle or keyed. Default "rle".')
+
     parser.add_option('-b', '--bbox', dest='bbox',
                       help='Bounding box in floating point geographic coordinates: south west north east.',
                       type='float', nargs=4)
 
+    parser.add_option('-t', '--threads', dest='threads', type='int', default=NUM_THREADS,
+                      help='Number of concurrent requests, each over its own keep-alive connection, or of render processes with --direct. Default %d.' % NUM_THREADS)
+
+    parser.add_option('-D', '--direct', dest='direct', action="store_true",
+                      help='Render tiles in process straight into a tile cache directory instead of requesting them from a server')
+
+    parser.add_option('--coverage', dest='coverage', type='choice',
+                      choices=['envelope', 'features'],
+                      help='Only seed tiles that intersect the extent of a layer (envelope, from the fields.json endpoint of a server started with --inspect) or of a feature (features, with --direct)')
+
+    parser.add_option('-C', '--checkpoint', dest='checkpoint',
+                      help='File that records finished columns of tiles, from which an interrupted seed resumes')
+
+    parser.add_option('-S', '--skip-existing', dest='skip_existing', action="store_true",
+                      help='Skip tiles that are already in the tile cache in --tile_cache_dir')
+
+    parser.add_option('--max-age', dest='max_age', type='int', default=0,
+                      help='Seconds after which tiles of the file tile cache are seeded again with --skip-existing. Default 0, never.')
+
+    parser.add_option('--tile_cache_dir', dest='tile_cache_dir', default='tiles',
+                      help='Tile cache directory of the server. Default "tiles".')
+
+    parser.add_option('--tile_cache_backend', dest='tile_cache_backend', default='file',
+                      help='Tile cache storage of the server, file or sqlite, with --direct. Default "file".')
+
+    parser.add_option('--map_cache_dir', dest='map_cache_dir', default='mapfiles',
+                      help='Map cache directory of the server, with --direct. Default "mapfiles".')
+
+    parser.add_option('--buffer_size', dest='buffer_size', type='int', default=128,
+                      help='Mapnik buffer size, with --direct. Default 128.')
+
+    parser.add_option('--tilesize', dest='tilesize', type='int', default=256,
+                      help='Size of rendered tiles, with --direct. Default 256.')
+
+    parser.add_option('--rows', dest='rows', type='int', default=16,
+                      help='Tiles of a column rendered per job, with --direct. Default 16.')
+
+    parser.add_option('-v', '--verbose', dest='verbose', action="store_true",
+                      help='Print the time taken by every tile')
+
     parser.add_option('-e', '--extension', dest='extension', default="png",
                       help='Optional file type for rendered tiles. Default value is "png".')
 
     options, zooms = parser.parse_args()
 
-    if options.url and options.extension:
+    if options.coverage == 'features' and not options.direct:
+        parser.error("--coverage=features needs --direct")
+    if options.direct and options.mapfile and options.extension:
+        seed_direct(options.bbox, int(zooms[0]), int(zooms[1]), options)
+    elif options.url and options.extension:
         render_tiles(options.bbox, int(zooms[0]), int(zooms[1]), options)
     else:
         parser.error("required arguments missing")